@@ -0,0 +1,58 @@
+import numpy as np
+
+
+# Tryb kompaktowy: indeks z [-1, 1] zapisany jako int16 = round(wartość * 10000), błąd <= 5e-5
+INDEX_SCALE = 10000
+INDEX_DTYPE = np.dtype(np.int16)
+# Zarezerwowana wartość int16 dla NaN (brak danych / maska)
+INDEX_NODATA = -32768
+
+QUANTIZE_BLOCK_PIXELS = 1024 * 1024
+
+
+def is_compact(array) -> bool:
+    """Whether an index array is stored in the scaled int16 form"""
+    return array.dtype == INDEX_DTYPE
+
+
+def _row_blocks(array, block_pixels):
+    rows = max(1, block_pixels // max(array.shape[-1], 1))
+    for r in range(0, array.shape[-2], rows):
+        yield (Ellipsis, slice(r, r + rows), slice(None))
+
+
+def quantize_index(values, out=None, block_pixels=QUANTIZE_BLOCK_PIXELS):
+    """Scaled int16 copy of float index values (NaN -> INDEX_NODATA), converted in row blocks"""
+    values = np.asarray(values)
+    if out is None:
+        out = np.empty(values.shape, dtype=INDEX_DTYPE)
+    for block in _row_blocks(values, block_pixels):
+        scaled = np.multiply(values[block], INDEX_SCALE, dtype=np.float32)
+        np.rint(scaled, out=scaled)
+        np.clip(scaled, INDEX_NODATA + 1, -INDEX_NODATA - 1, out=scaled)
+        np.copyto(scaled, INDEX_NODATA, where=np.isnan(scaled))
+        np.copyto(out[block], scaled, casting="unsafe")
+    return out
+
+
+def dequantize_index(values, out=None, dtype=np.float32):
+    """Float index values of a scaled int16 array (INDEX_NODATA -> NaN); float arrays are returned as they are"""
+    values = np.asarray(values)
+    if not is_compact(values):
+        return values
+    out = np.divide(values, INDEX_SCALE, out=out, dtype=dtype)
+    np.copyto(out, np.nan, where=values == INDEX_NODATA)
+    return out
+
+
+def cast_index(values, dtype):
+    """Index block in the storage ``dtype``: quantized for int16, a plain cast otherwise"""
+    if np.dtype(dtype) == INDEX_DTYPE:
+        return quantize_index(values)
+    return values.astype(dtype, copy=False)
+
+
+def fill_nodata(array):
+    """Fill an index array (float or compact) with its no-data value"""
+    array.fill(INDEX_NODATA if is_compact(array) else np.nan)
+    return array
@@ -0,0 +1,98 @@
+import os
+import tempfile
+
+import numpy as np
+import rasterio
+from rasterio.shutil import copy as copy_dataset
+
+
+# Kodeki COG: (minimalny, maksymalny, domyślny) poziom kompresji; LZW nie ma poziomów
+COG_CODECS = {
+    "DEFLATE": (1, 9, 6),
+    "ZSTD": (1, 22, 9),
+    "LZW": None,
+}
+DEFAULT_CODEC = "DEFLATE"
+
+COG_BLOCK_SIZE = 512
+
+# Plik pośredni: kafle jak w COG, szybka kompresja (i tak jest przepisywany)
+_SCRATCH_OPTIONS = dict(tiled=True, blockxsize=COG_BLOCK_SIZE, blockysize=COG_BLOCK_SIZE,
+                        compress="DEFLATE", zlevel=1)
+
+
+def _is_float(dtype):
+    return np.dtype(dtype).kind == "f"
+
+
+def cog_options(codec=DEFAULT_CODEC, level=None, dtype="float32"):
+    """COG driver creation options: 512 px tiles, predictor (3 for floats, 2 for integers), codec and level"""
+    if codec not in COG_CODECS:
+        raise ValueError(f"Unsupported COG codec: {codec}")
+    options = {
+        "BLOCKSIZE": str(COG_BLOCK_SIZE),
+        "COMPRESS": codec,
+        "PREDICTOR": "FLOATING_POINT" if _is_float(dtype) else "STANDARD",
+        "OVERVIEW_RESAMPLING": "AVERAGE",
+        "RESAMPLING": "AVERAGE",
+        "BIGTIFF": "IF_SAFER",
+    }
+    if level is not None and COG_CODECS[codec] is not None:
+        lo, hi, _ = COG_CODECS[codec]
+        options["LEVEL"] = str(int(np.clip(level, lo, hi)))
+    return options
+
+
+def export_profile(profile, count, dtype="float32", nodata=np.nan):
+    """Tiled scratch-file profile on the grid of ``profile`` (striping, interleave etc. are dropped)"""
+    return dict(
+        driver="GTiff",
+        width=profile["width"],
+        height=profile["height"],
+        count=count,
+        dtype=dtype,
+        crs=profile.get("crs"),
+        transform=profile["transform"],
+        nodata=nodata,
+        predictor=3 if _is_float(dtype) else 2,
+        **_SCRATCH_OPTIONS,
+    )
+
+
+def write_array_blocks(dst, array):
+    """Write an (h, w) array or (n, h, w) stack into ``dst`` tile by tile (no full-size cast copy)"""
+    array = array[None] if array.ndim == 2 else array
+    dtype = dst.dtypes[0]
+    for _, window in dst.block_windows(1):
+        dst.write(array[(slice(None),) + window.toslices()].astype(dtype, copy=False), window=window)
+
+
+def write_cog(path, profile, count, fill, names=None, codec=DEFAULT_CODEC, level=None, dtype="float32",
+              nodata=np.nan, scale=None):
+    """Write a Cloud-Optimized GeoTIFF to ``path``.
+
+    ``fill(dst)`` writes the bands window by window into a tiled scratch GeoTIFF,
+    so no full-size array has to exist; GDAL's COG driver then copies it tile by tile,
+    building the internal overviews. ``names`` become band descriptions; ``scale``
+    is stored as the band scale factor (value = stored * scale) of every band.
+    """
+    with tempfile.TemporaryDirectory(prefix="cog-") as scratch_dir:
+        scratch = os.path.join(scratch_dir, "scratch.tif")
+        with rasterio.open(scratch, "w", **export_profile(profile, count, dtype, nodata)) as dst:
+            fill(dst)
+            for i, name in enumerate(names or (), start=1):
+                dst.set_band_description(i, name)
+            if scale is not None:
+                dst.scales = (scale,) * count
+                dst.offsets = (0.0,) * count
+        with rasterio.open(scratch) as src:
+            copy_dataset(src, path, driver="COG", **cog_options(codec, level, dtype))
+
+
+def cog_bytes(profile, count, fill, **kwargs):
+    """Bytes of a COG written by ``write_cog`` (for downloads)"""
+    with tempfile.TemporaryDirectory(prefix="cog-") as out_dir:
+        path = os.path.join(out_dir, "export.tif")
+        write_cog(path, profile, count, fill, **kwargs)
+        with open(path, "rb") as f:
+            return f.read()
@@ -0,0 +1,142 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+import rasterio
+from rasterio.io import MemoryFile
+
+from Pages.raster_cache import upload_hash
+from Pages.spectral import grid_profile, read_on_grid, read_valid_on_grid
+
+
+# GDAL zwalnia GIL podczas dekompresji, więc wątki dekodują pasma równolegle
+DECODE_WORKERS = min(8, os.cpu_count() or 1)
+DECODER = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="band-decode")
+
+# Wątek w tle dla pełnej rozdzielczości (osobny, żeby nie blokować dekodera)
+BACKGROUND = ThreadPoolExecutor(max_workers=2, thread_name_prefix="background")
+
+# Odczyty podglądu mają własną małą pulę: nie czekają w kolejce za dekodowaniem pełnej rozdzielczości
+PREVIEW_READER = ThreadPoolExecutor(max_workers=min(4, DECODE_WORKERS), thread_name_prefix="preview-read")
+
+# Słowniki "pending" są modyfikowane z wątku głównego i z wątków w tle
+_PENDING_LOCK = threading.Lock()
+
+# Większe pliki są czytane przez plik tymczasowy zamiast /vsimem
+MEMORYFILE_MAX_BYTES = 1024 ** 3
+
+
+@contextmanager
+def upload_path(uploaded_file):
+    """Path of a temp-file copy of an upload; the temp file is always removed"""
+    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".tif")
+    try:
+        temp_file.write(uploaded_file.getbuffer())
+        temp_file.close()
+        yield temp_file.name
+    finally:
+        temp_file.close()
+        try:
+            os.unlink(temp_file.name)
+        except OSError:
+            pass
+
+
+@contextmanager
+def open_upload(uploaded_file):
+    """Open an uploaded GeoTIFF straight from its in-memory buffer, without a disk round trip.
+
+    Uploads larger than MEMORYFILE_MAX_BYTES go through a temp file instead, so a
+    huge file does not have to exist twice in RAM while it is being decoded.
+    """
+    buffer = uploaded_file.getbuffer()
+    try:
+        if buffer.nbytes > MEMORYFILE_MAX_BYTES:
+            with upload_path(uploaded_file) as path, rasterio.open(path) as src:
+                yield src
+        else:
+            with MemoryFile(buffer) as memfile, memfile.open() as src:
+                yield src
+    finally:
+        buffer.release()
+
+
+def band_profile(uploaded_file, profile_cache):
+    """Profile of an upload (header only), memoized per upload content"""
+    key = upload_hash(uploaded_file)
+    profile = profile_cache.get(key)
+    if profile is None:
+        with open_upload(uploaded_file) as src:
+            profile = src.profile
+        profile_cache.put(key, profile)
+    return profile
+
+
+def decode_band(uploaded_file, grid=None, resampling="bilinear"):
+    """Decoded band array (native dtype), profile and validity mask (None = no nodata/mask), on ``grid``"""
+    with open_upload(uploaded_file) as src:
+        array = read_on_grid(src, grid, resampling=resampling)
+        valid = read_valid_on_grid(src, grid)
+        profile = src.profile if grid is None else grid_profile(src.profile, grid)
+    return array, profile, valid
+
+
+def _band_key(uploaded_file, grid, resampling):
+    return upload_hash(uploaded_file), grid, resampling
+
+
+def _submit_decode(uploaded_file, key, band_cache):
+    _, grid, resampling = key
+    future = DECODER.submit(decode_band, uploaded_file, grid, resampling)
+    future.add_done_callback(
+        lambda f: band_cache.put(key, f.result()) if f.exception() is None else None
+    )
+    return future
+
+
+def prefetch_bands(uploads, band_cache, pending, grid=None, resampling="bilinear") -> int:
+    """Start decoding uploads in the background; returns the number of newly started decodes.
+
+    ``uploads`` maps band names to uploaded files and ``pending`` maps band keys
+    (content hash, grid, resampling) to in-flight futures (kept in session state
+    between reruns).
+    """
+    started = 0
+    with _PENDING_LOCK:
+        for key in [k for k, f in pending.items() if f.done()]:
+            del pending[key]
+
+        for uploaded_file in uploads.values():
+            key = _band_key(uploaded_file, grid, resampling)
+            if key in band_cache or key in pending:
+                continue
+            pending[key] = _submit_decode(uploaded_file, key, band_cache)
+            started += 1
+    return started
+
+
+def load_bands(uploads, band_cache, pending, grid=None, resampling="bilinear"):
+    """Decoded (array, profile, valid) per band; cached bands are reused, the rest are decoded concurrently"""
+    keys = {b: _band_key(f, grid, resampling) for b, f in uploads.items()}
+    decoded = {}
+    futures = {}
+    with _PENDING_LOCK:
+        for b, uploaded_file in uploads.items():
+            key = keys[b]
+            cached = band_cache.get(key)
+            if cached is not None:
+                decoded[b] = cached
+            elif key in pending:
+                futures[b] = pending[key]
+            else:
+                futures[b] = pending[key] = _submit_decode(uploaded_file, key, band_cache)
+
+    wait(futures.values())
+    with _PENDING_LOCK:
+        for b in futures:
+            pending.pop(keys[b], None)
+    for b, future in futures.items():
+        decoded[b] = future.result()
+    return decoded
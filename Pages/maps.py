@@ -1,16 +1,69 @@
 import streamlit as st
-import rasterio
-import geopandas as gpd
+from rasterio.warp import transform_bounds
 import numpy as np
 import folium
+from folium.utilities import camelize
 from streamlit_folium import st_folium
-from rasterstats import zonal_stats
-import tempfile
+from branca.element import MacroElement
+from jinja2 import Template
 import os
 from matplotlib import pyplot as plt
 from matplotlib.patches import FancyArrow, Rectangle
 from matplotlib.font_manager import FontProperties
-import io
+from contextlib import ExitStack
+from functools import partial
+
+from Pages.ingest import (
+    BACKGROUND, DECODER, PREVIEW_READER, band_profile, load_bands, open_upload, prefetch_bands, upload_path,
+)
+from Pages.pipeline import StageGraph, fingerprint
+from Pages.spectral import (
+    GRID_COARSEST, GRID_CUSTOM, GRID_FINEST, INDEX_FORMULAS, combine_valid, compute_indices_masked,
+    compute_indices_tiled,
+    grid_profile, preview_grid, required_bands, stream_indices, target_grid,
+)
+from Pages.masking import (
+    DEFAULT_CIRRUS_THRESHOLD, DEFAULT_RADIOMETRIC_OFFSET, DEFAULT_SCL_MASK, QA60_CLOUD_BITS, SCL_CLASSES,
+    layer_valid, mask_rules,
+)
+from Pages.compact import INDEX_NODATA, INDEX_SCALE, is_compact
+from Pages.export import COG_CODECS, DEFAULT_CODEC, cog_bytes, write_array_blocks
+from Pages.render import CANVAS_SIZE, composite, decoration_layer, encode_image, render_raster
+from Pages.tiles import overlay_url, tile_origin, tile_url
+from Pages.vectors import OVERLAY_ZOOMS, VECTOR_TYPES, raster_footprint, read_vector
+from Pages.zonal import build_zones, coverage_weights, histogram_columns, weighted_zonal_table, zonal_table
+from Pages.statistics import HIST_BINS, array_stats, progressive_array_stats, summarize_stats
+from Pages.raster_cache import (
+    BAND_CACHE_BYTES, LAYER_CACHE_BYTES, PROFILE_CACHE_BYTES, RESULT_CACHE_BYTES, ZONE_CACHE_BYTES,
+    content_hash, session_cache, upload_hash,
+)
+
+ENGINE_IN_MEMORY = "In-memory (cached bands)"
+ENGINE_STREAMING = "Streaming (bounded memory)"
+ENGINE_TILED = "Multi-core tiles (process pool)"
+
+INDEX_OPTIONS = [
+    "NDVI", "EVI", "SAVI", "GNDVI", "NDRE",
+    "NDWI", "MNDWI", "NDMI",
+    "NDBI", "BSI", "UI",
+    "NBR", "BAIS2", "NBR2",
+    "NDSI", "S2WI",
+]
+
+PRECISION_FAST = "Fast (float32)"
+PRECISION_PRECISE = "Precise (float64)"
+PRECISION_COMPACT = "Compact (scaled int16)"
+# Typ obliczeń; tryb kompaktowy liczy w float32 i przechowuje wynik jako int16 * 1e-4
+PRECISION_DTYPES = {PRECISION_FAST: "float32", PRECISION_PRECISE: "float64", PRECISION_COMPACT: "float32"}
+
+ZONAL_CENTRE = "Pixel centre"
+ZONAL_WEIGHTED = "Area-weighted (exact coverage)"
+
+GRID_MODES = {
+    "Finest band resolution": GRID_FINEST,
+    "Coarsest band resolution (fast)": GRID_COARSEST,
+    "Custom resolution": GRID_CUSTOM,
+}
 
 
 def render():
@@ -55,28 +108,100 @@ def render():
 
         st.markdown("#### 📐 Vector Data")
         uploaded_vector = st.file_uploader(
-            "Upload GeoJSON (optional)",
-            type=["geojson", "json"],
-            help="For zonal statistics",
+            "Upload vector layer (optional)",
+            type=VECTOR_TYPES,
+            help="For zonal statistics: GeoJSON, GeoPackage, FlatGeobuf, KML or a Shapefile zipped with its "
+                 ".shx/.dbf/.prj files. "
+                 "Only features overlapping the raster are read; they are reprojected to its CRS.",
             key="vector_upload",
         )
 
         if uploaded_vector:
             st.success(f"✓ {uploaded_vector.name}")
 
+        zonal_mode = st.radio(
+            "Zonal statistics",
+            [ZONAL_CENTRE, ZONAL_WEIGHTED],
+            index=0,
+            disabled=not uploaded_vector,
+            help="Pixel centre counts the pixels whose centre falls inside a feature (median, "
+                 "percentiles, histograms). Area-weighted weights every pixel by the exact "
+                 "fraction of it covered by the feature, so small parcels and edges are counted "
+                 "correctly (mean, std, sum, covered area).",
+        )
+
         st.markdown("---")
         st.markdown("### ⚙️ Analysis Settings")
 
+        # Stałe opcje i klucz: zmiana wyświetlanego indeksu nie zmienia wsadu (ani odcisku 'indices')
+        batch_selection = st.multiselect(
+            "Spectral indices",
+            INDEX_OPTIONS,
+            default=INDEX_OPTIONS[:1],
+            key="batch_indices",
+            help="Computed in the same pass (each band is read once) and exported "
+                 "together as one multi-band GeoTIFF.",
+        )
+        batch_indices = [i for i in INDEX_OPTIONS if i in batch_selection] or INDEX_OPTIONS[:1]
+
+        shown = st.session_state.get("_shown_index")
         index_type = st.selectbox(
-            "Spectral Index",
-            [
-                "NDVI", "EVI", "SAVI", "GNDVI", "NDRE",
-                "NDWI", "MNDWI", "NDMI",
-                "NDBI", "BSI", "UI",
-                "NBR", "BAIS2", "NBR2",
-                "NDSI", "S2WI",
-            ],
-            help="Select spectral index to calculate",
+            "Displayed index",
+            batch_indices,
+            index=batch_indices.index(shown) if shown in batch_indices else 0,
+            help="Index shown on the map, in the statistics and in single-index downloads; "
+                 "switching between indices of the batch does not recompute them.",
+        )
+        st.session_state["_shown_index"] = index_type
+
+        with st.expander("☁️ Cloud masking", expanded=False):
+            # Domyślnie włączone tylko gdy pasmo SCL jest wgrane (bez niego maskowanie i tak nie działa)
+            use_scl = st.checkbox(
+                "Mask with SCL band",
+                value=any(_detect_band(f.name) == "SCL" for f in uploaded_bands or []),
+                help="Uses an uploaded Scene Classification (SCL) band of an L2A product.",
+            )
+            scl_classes = st.multiselect(
+                "SCL classes to mask",
+                list(SCL_CLASSES.keys()),
+                default=list(DEFAULT_SCL_MASK),
+                format_func=lambda c: f"{c} - {SCL_CLASSES[c]}",
+                disabled=not use_scl,
+            )
+            use_cirrus = st.checkbox("Mask cirrus with B10 threshold", value=False)
+            cirrus_threshold = st.number_input(
+                "B10 reflectance threshold",
+                min_value=0.0,
+                max_value=1.0,
+                value=DEFAULT_CIRRUS_THRESHOLD,
+                step=0.001,
+                format="%.3f",
+                disabled=not use_cirrus,
+            )
+            radiometric_offset = st.number_input(
+                "B10 DN offset",
+                min_value=0.0,
+                max_value=10000.0,
+                value=DEFAULT_RADIOMETRIC_OFFSET,
+                step=1000.0,
+                format="%.0f",
+                disabled=not use_cirrus,
+                help="Radiometric offset added to the L1C digital numbers: 1000 for processing baseline "
+                     "04.00 and later (products since January 2022), 0 for older products.",
+            )
+            use_qa = st.checkbox(
+                "Mask QA60 cloud bits",
+                value=False,
+                help="Opaque cloud (bit 10) and cirrus (bit 11) flags of an L1C QA60 band.",
+            )
+            st.caption("Masked pixels are excluded while the bands are read; upload the SCL / B10 / "
+                       "QA60 files together with the bands.")
+
+        mask_options = dict(
+            scl_classes=tuple(scl_classes) if use_scl else (),
+            cirrus_threshold=float(cirrus_threshold) if use_cirrus else None,
+            radiometric_offset=float(radiometric_offset),
+            qa_bits=QA60_CLOUD_BITS if use_qa else 0,
         )
 
         colormap_options = {
@@ -94,6 +219,88 @@ def render():
             "Greys": "Greys",
         }
 
+        with st.expander("⚡ Performance", expanded=False):
+            engine = st.radio(
+                "Processing engine",
+                [ENGINE_IN_MEMORY, ENGINE_STREAMING, ENGINE_TILED],
+                index=0,
+                help="Streaming evaluates the index block by block, so memory is bounded "
+                     "by the block size instead of the scene size. Multi-core tiles splits "
+                     "the scene into tiles computed in parallel worker processes.",
+            )
+            workers = st.number_input(
+                "Worker processes",
+                min_value=1,
+                max_value=max(os.cpu_count() or 1, 1),
+                value=max(os.cpu_count() or 1, 1),
+                step=1,
+                disabled=engine != ENGINE_TILED,
+                help="Number of processes used by the multi-core tiles engine.",
+            )
+            precision = st.radio(
+                "Precision",
+                [PRECISION_FAST, PRECISION_PRECISE, PRECISION_COMPACT],
+                index=0,
+                help="float32 halves memory traffic; float64 keeps full double precision. Compact "
+                     "stores the index as int16 scaled by 10000 (error < 1e-4): half the memory of "
+                     "float32 for the cached result, zonal statistics and GeoTIFF export.",
+            )
+            grid_label = st.selectbox(
+                "Target grid",
+                list(GRID_MODES.keys()),
+                index=0,
+                help="Bands with different resolutions (10 m / 20 m) are resampled onto this grid "
+                     "while they are read. The coarsest grid reads 10 m bands decimated.",
+            )
+            grid_resolution = st.number_input(
+                "Custom resolution (m)",
+                min_value=1.0,
+                value=10.0,
+                step=5.0,
+                disabled=GRID_MODES[grid_label] != GRID_CUSTOM,
+            )
+            resampling = st.selectbox(
+                "Resampling",
+                ["bilinear", "nearest", "average", "cubic"],
+                index=0,
+                help="Resampling method used when a band is read onto the target grid.",
+            )
+            progressive = st.checkbox(
+                "Progressive preview",
+                value=True,
+                help="Shows the map read at display resolution right away; the full-resolution "
+                     "index for statistics and downloads is computed in the background.",
+            )
+
+        engine_options = dict(
+            engine=engine,
+            workers=int(workers),
+            precision=precision,
+            grid_mode=GRID_MODES[grid_label],
+            grid_resolution=float(grid_resolution),
+            resampling=resampling,
+        )
+
+        with st.expander("💾 Export", expanded=False):
+            codec = st.selectbox(
+                "GeoTIFF compression",
+                list(COG_CODECS.keys()),
+                index=list(COG_CODECS.keys()).index(DEFAULT_CODEC),
+                help="GeoTIFF downloads are Cloud-Optimized (512 px tiles, internal overviews, "
+                     "floating-point predictor).",
+            )
+            levels = COG_CODECS[codec]
+            level = st.slider(
+                "Compression level",
+                min_value=levels[0] if levels else 1,
+                max_value=levels[1] if levels else 9,
+                value=levels[2] if levels else 1,
+                disabled=levels is None,
+                help="Higher levels give smaller files but are slower to write.",
+            )
+
+        export_options = dict(codec=codec, level=int(level) if levels else None)
+
         selected_colormap = st.selectbox("Color Palette", list(colormap_options.keys()), index=0)
         reverse_cmap = st.checkbox("Reverse Palette", value=False)
 
@@ -133,8 +340,17 @@ def render():
 
         st.info("Scale bar shows **exact calculated distance** (no rounding).")
 
+        show_debug = st.checkbox(
+            "Show pipeline stages (debug)",
+            value=False,
+            help="Lists which processing stages were recomputed and which came from cache.",
+        )
+
         st.markdown("---")
 
+        if uploaded_bands and engine == ENGINE_IN_MEMORY:
+            _prefetch_uploaded_bands(uploaded_bands, batch_indices, engine_options)
+
         if uploaded_bands:
             if st.button("🚀 Run Analysis", use_container_width=True, type="primary"):
                 st.session_state.run_analysis = True
@@ -152,7 +368,12 @@ def render():
         process_raster_data(
             uploaded_bands=uploaded_bands,
             uploaded_vector=uploaded_vector,
+            zonal_mode=zonal_mode,
             index_type=index_type,
+            batch_indices=batch_indices,
+            engine_options=engine_options,
+            mask_options=mask_options,
+            export_options=export_options,
             colormap=selected_colormap,
             reverse_cmap=reverse_cmap,
             map_title=st.session_state.get("map_title", f"{index_type} Analysis"),
@@ -162,6 +383,8 @@ def render():
             scale_mode=st.session_state.get("scale_mode", "Auto from GeoTIFF (projected CRS)"),
             manual_m_per_px=float(st.session_state.get("manual_m_per_px", 10.0)),
             scale_bar_percentage=int(st.session_state.get("scale_bar_percentage", 90)),
+            show_debug=show_debug,
+            progressive=progressive,
         )
     elif uploaded_bands:
         st.info("👈 Click 'Run Analysis' in the sidebar to start processing")
@@ -169,152 +392,384 @@ def render():
         st.info("👈 Upload raster files using the sidebar to begin")
 
 
-def process_raster_data(uploaded_bands, uploaded_vector, index_type, colormap, reverse_cmap,
+def process_raster_data(uploaded_bands, uploaded_vector, zonal_mode, index_type, batch_indices, engine_options,
+                        mask_options, export_options, colormap, reverse_cmap,
                         map_title, show_scale, show_north, show_legend,
-                        scale_mode, manual_m_per_px, scale_bar_percentage):
+                        scale_mode, manual_m_per_px, scale_bar_percentage, show_debug=False,
+                        progressive=False):
+    run = None
     try:
-        temp_files = []
         band_data = {}
 
         with st.spinner("🔄 Loading raster data..."):
             for band_file in uploaded_bands:
-                temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".tif")
-                temp_file.write(band_file.read())
-                temp_file.close()
-                temp_files.append(temp_file.name)
-
-                filename = band_file.name.upper()
-                if "B04" in filename or "B4_" in filename or "_B4." in filename:
-                    band_data["B4"] = temp_file.name
-                elif "B03" in filename or "B3_" in filename or "_B3." in filename:
-                    band_data["B3"] = temp_file.name
-                elif "B02" in filename or "B2_" in filename or "_B2." in filename:
-                    band_data["B2"] = temp_file.name
-                elif "B05" in filename or "B5_" in filename or "_B5." in filename:
-                    band_data["B5"] = temp_file.name
-                elif "B06" in filename or "B6_" in filename or "_B6." in filename:
-                    band_data["B6"] = temp_file.name
-                elif "B07" in filename or "B7_" in filename or "_B7." in filename:
-                    band_data["B7"] = temp_file.name
-                elif "B08" in filename or "B8_" in filename or "_B8." in filename:
-                    band_data["B8"] = temp_file.name
-                elif "B8A" in filename or "B08A" in filename:
-                    band_data["B8A"] = temp_file.name
-                elif "B11" in filename:
-                    band_data["B11"] = temp_file.name
-                elif "B12" in filename:
-                    band_data["B12"] = temp_file.name
+                band = _detect_band(band_file.name)
+                if band is not None:
+                    band_data[band] = band_file
 
         st.success(f"✅ Loaded {len(band_data)} bands: {', '.join(band_data.keys())}")
 
-        index_result = calculate_spectral_index(band_data, index_type)
-        if index_result is None:
-            return
+        preview = progressive and _needs_preview(band_data, index_type, engine_options)
+        stage_cache = session_cache("stages", RESULT_CACHE_BYTES)
+        run = PIPELINE.run(
+            params=dict(
+                band_data=band_data,
+                uploaded_vector=uploaded_vector,
+                zonal_mode=zonal_mode,
+                index_type=index_type,
+                batch_indices=batch_indices,
+                engine_options=engine_options,
+                mask_options=mask_options,
+                export_options=export_options,
+                preview=preview,
+                colormap=colormap,
+                reverse_cmap=reverse_cmap,
+                map_title=map_title,
+                show_scale=show_scale,
+                show_north=show_north,
+                show_legend=show_legend,
+                scale_mode=scale_mode,
+                manual_m_per_px=manual_m_per_px,
+                scale_bar_percentage=scale_bar_percentage,
+            ),
+            cache=stage_cache,
+        )
 
-        index_array, profile = index_result
-        st.success(f"✅ {index_type} calculated successfully!")
+        # W trybie podglądu pełna rozdzielczość liczy się w tle i nie blokuje mapy
+        run.value("indices", background=preview)
+        # Statystyki są nad mapą, ale pojawiają się dopiero po pełnym przeliczeniu
+        stats_area = st.container()
+        if run.value("display") is None:
+            return
+        index = run.value("index")
+        with stats_area:
+            if index is None:
+                st.info("⏳ Showing a display-resolution preview. Full-resolution statistics "
+                        "and downloads are being computed in the background...")
+            else:
+                if len(batch_indices) > 1:
+                    st.success(f"✅ {', '.join(batch_indices)} calculated in one pass! Showing {index_type}.")
+                else:
+                    st.success(f"✅ {index_type} calculated successfully!")
+                if ("indices", run.fingerprint("indices")) not in stage_cache:
+                    st.warning(f"⚠️ The result ({_format_bytes(index[0].nbytes * len(batch_indices))}) does not "
+                               f"fit the {_format_bytes(stage_cache.max_bytes)} result cache, so every change "
+                               "of the map settings recomputes it. Use fewer indices, a coarser grid or the "
+                               "compact precision.")
+                stats_panel = st.empty()
+
+        st.markdown("### 🎨 Index Visualization")
+        st.image(run.value("figure"), use_column_width=True)
+        st.markdown("---")
 
-        display_statistics(index_array, index_type)
+        if index is None:
+            _await_background_job()
+            return
 
-        fig = visualize_index_pixel_space(
-            index_array=index_array,
-            profile=profile,
-            index_type=index_type,
-            colormap=colormap,
-            reverse_cmap=reverse_cmap,
-            map_title=map_title,
-            show_scale=show_scale,
-            show_north=show_north,
-            show_legend=show_legend,
-            scale_mode=scale_mode,
-            manual_m_per_px=manual_m_per_px,
-            scale_bar_percentage=scale_bar_percentage,
-        )
+        # Szacunki z próbki pojawiają się od razu i są zastępowane dokładnymi wartościami
+        stats = run.value("stats", progress=partial(_show_statistics, stats_panel, index_type=index_type))
+        _show_statistics(stats_panel, stats, index_type)
 
-        if uploaded_vector:
-            process_vector_analysis(uploaded_vector, index_array, profile, index_type)
+        # Mapa rysuje warstwę stref tylko wtedy, gdy statystyki strefowe się udały i objęły jakieś obiekty
+        zonal = process_vector_analysis(run, batch_indices) if uploaded_vector else None
 
-        create_interactive_map(index_array, profile, index_type)
-        create_download_section(index_array, profile, index_type, fig)
+        create_interactive_map(run, show_zonal=zonal is not None and len(zonal) > 0)
+        create_download_section(run, index_type, batch_indices)
 
     except Exception as e:
         st.error(f"❌ Error processing data: {str(e)}")
         st.exception(e)
     finally:
-        for f in temp_files:
-            try:
-                os.unlink(f)
-            except Exception:
-                pass
-
-
-def calculate_spectral_index(band_data, index_type):
-    index_formulas = {
-        "NDVI": {"bands": ["B4", "B8"], "formula": lambda r, n: (n - r) / (n + r + 1e-10)},
-        "EVI": {"bands": ["B2", "B4", "B8"],
-                "formula": lambda b, r, n: 2.5 * ((n - r) / (n + 6 * r - 7.5 * b + 1 + 1e-10))},
-        "SAVI": {"bands": ["B4", "B8"], "formula": lambda r, n: ((n - r) / (n + r + 0.5)) * 1.5},
-        "GNDVI": {"bands": ["B3", "B8"], "formula": lambda g, n: (n - g) / (n + g + 1e-10)},
-        "NDRE": {"bands": ["B5", "B8"], "formula": lambda re, n: (n - re) / (n + re + 1e-10)},
-
-        "NDWI": {"bands": ["B3", "B8"], "formula": lambda g, n: (g - n) / (g + n + 1e-10)},
-        "MNDWI": {"bands": ["B3", "B11"], "formula": lambda g, s: (g - s) / (g + s + 1e-10)},
-        "NDMI": {"bands": ["B8", "B11"], "formula": lambda n, s: (n - s) / (n + s + 1e-10)},
-
-        "NDBI": {"bands": ["B8", "B11"], "formula": lambda n, s: (s - n) / (s + n + 1e-10)},
-        "BSI": {"bands": ["B2", "B4", "B8", "B11"],
-                "formula": lambda b, r, n, s: ((s + r) - (n + b)) / ((s + r) + (n + b) + 1e-10)},
-        "UI": {"bands": ["B8", "B12"], "formula": lambda n, s: (s - n) / (s + n + 1e-10)},
-
-        "NBR": {"bands": ["B8", "B12"], "formula": lambda n, s: (n - s) / (n + s + 1e-10)},
-        "NBR2": {"bands": ["B11", "B12"], "formula": lambda s1, s2: (s1 - s2) / (s1 + s2 + 1e-10)},
-        "BAIS2": {"bands": ["B4", "B6", "B7", "B8A", "B12"],
-                  "formula": lambda r, re2, re3, nir_n, swir2:
-                  (1 - np.sqrt((re2 * re3 * nir_n) / (r + 1e-10))) *
-                  ((swir2 - nir_n) / (np.sqrt(swir2 + nir_n) + 1) + 1)},
-
-        "NDSI": {"bands": ["B3", "B11"], "formula": lambda g, s: (g - s) / (g + s + 1e-10)},
-        "S2WI": {"bands": ["B8", "B12"], "formula": lambda n, s: (n - s) / (n + s + 1e-10)},
-    }
-
-    if index_type not in index_formulas:
-        st.error(f"Index {index_type} not implemented")
+        if show_debug and run is not None:
+            with st.expander("🧩 Pipeline stages", expanded=True):
+                st.dataframe(run.report, use_container_width=True)
+
+
+@st.fragment(run_every=1.0)
+def _await_background_job():
+    """Odświeża stronę, gdy obliczenia w tle się zakończą"""
+    jobs = st.session_state.get("_background_jobs", {})
+    done = {key for key, future in jobs.items() if future.done()}
+    # Zakończone zadania, których nikt już nie odbiera (stare ustawienia), nie odświeżają strony w kółko
+    if done - st.session_state.get("_reran_for_jobs", set()):
+        st.session_state["_reran_for_jobs"] = done
+        st.rerun()
+
+
+def _run_in_background(key, job):
+    """Result of ``job`` computed on the background executor, or None while it is still running.
+
+    ``key`` is a (kind, fingerprint) pair; a new job cancels stale jobs of the same kind.
+    """
+    jobs = st.session_state.setdefault("_background_jobs", {})
+    future = jobs.get(key)
+    if future is None:
+        # Zadania tego samego rodzaju dla poprzednich ustawień nie są już potrzebne
+        for stale_key in [k for k in jobs if k[0] == key[0]]:
+            jobs.pop(stale_key).cancel()
+        future = jobs[key] = BACKGROUND.submit(job)
+    if not future.done():
+        return None
+    del jobs[key]
+    return future.result()
+
+
+def _detect_band(filename):
+    """Rozpoznaje kanał Sentinel-2 na podstawie nazwy pliku"""
+    filename = filename.upper()
+    if "SCL" in filename:
+        return "SCL"
+    elif "QA60" in filename:
+        return "QA60"
+    elif "B04" in filename or "B4_" in filename or "_B4." in filename:
+        return "B4"
+    elif "B03" in filename or "B3_" in filename or "_B3." in filename:
+        return "B3"
+    elif "B02" in filename or "B2_" in filename or "_B2." in filename:
+        return "B2"
+    elif "B05" in filename or "B5_" in filename or "_B5." in filename:
+        return "B5"
+    elif "B06" in filename or "B6_" in filename or "_B6." in filename:
+        return "B6"
+    elif "B07" in filename or "B7_" in filename or "_B7." in filename:
+        return "B7"
+    elif "B08" in filename or "B8_" in filename or "_B8." in filename:
+        return "B8"
+    elif "B8A" in filename or "B08A" in filename:
+        return "B8A"
+    elif "B10" in filename:
+        return "B10"
+    elif "B11" in filename:
+        return "B11"
+    elif "B12" in filename:
+        return "B12"
+    return None
+
+
+def _prefetch_uploaded_bands(uploaded_bands, index_types, engine_options):
+    """Zaczyna dekodowanie potrzebnych pasm w tle, zanim użytkownik kliknie 'Run Analysis'"""
+    needed = required_bands(index_types)
+    uploads = {}
+    for band_file in uploaded_bands:
+        band = _detect_band(band_file.name)
+        if band in needed:
+            uploads[band] = band_file
+    if not uploads:
+        return
+
+    bands = [b for b in needed if b in uploads]
+    grid, _ = _resolve_grid(uploads, bands, engine_options["grid_mode"], engine_options["grid_resolution"])
+    prefetch_bands(
+        uploads,
+        session_cache("bands", BAND_CACHE_BYTES),
+        st.session_state.setdefault("_pending_decodes", {}),
+        grid=grid,
+        resampling=engine_options["resampling"],
+    )
+
+
+def _resolve_grid(band_data, bands, grid_mode, grid_resolution):
+    """Siatka docelowa i profil wyniku na podstawie nagłówków pasm"""
+    profile_cache = session_cache("profiles", PROFILE_CACHE_BYTES)
+    profiles = [band_profile(band_data[b], profile_cache) for b in bands]
+    grid = target_grid(profiles, grid_mode, grid_resolution)
+    return grid, grid_profile(profiles[0], grid)
+
+
+def calculate_spectral_index(band_data, index_types, engine=ENGINE_IN_MEMORY, precision=PRECISION_FAST,
+                             workers=1, grid_mode=GRID_FINEST, grid_resolution=None, resampling="bilinear",
+                             masks=None, background=False):
+    """Index array, profile and precomputed statistics (or None); decoded bands are cached per upload content.
+
+    ``index_types`` may be a single index name or a list of names. For a list every
+    required band is read once and shared, and the result is an (n, h, w) stack.
+    The multi-core tiles engine also returns merged per-tile statistics per index.
+    Bands are resampled onto a common target grid while they are read and pixels
+    rejected by the cloud-mask rules in ``masks`` (band -> rule) become NaN. With
+    ``background`` the computation runs on the background executor and None is
+    returned until it has finished.
+    """
+    single = isinstance(index_types, str)
+    if single:
+        index_types = [index_types]
+
+    if not _check_bands(band_data, index_types):
         return None
 
-    required_bands = index_formulas[index_type]["bands"]
-    formula = index_formulas[index_type]["formula"]
+    bands = required_bands(index_types)
+    dtype = PRECISION_DTYPES[precision]
+    compact = precision == PRECISION_COMPACT
+    grid, profile = _resolve_grid(band_data, bands, grid_mode, grid_resolution)
+
+    # Sesja (cache pasm) jest czytana tutaj, bo wątek w tle nie ma dostępu do st.session_state
+    job = partial(
+        _compute_spectral_index, band_data, bands, index_types, engine, dtype, compact, workers, grid, resampling,
+        masks or {}, session_cache("bands", BAND_CACHE_BYTES), st.session_state.setdefault("_pending_decodes", {}),
+    )
+    if background:
+        key = "indices", fingerprint((band_data, index_types, engine, precision, workers, grid_mode,
+                           grid_resolution, resampling, masks))
+        computed = _run_in_background(key, job)
+        if computed is None:
+            return None
+    else:
+        computed = job()
+    result, tile_stats = computed
+
+    if single:
+        return result[0], profile, (tile_stats[0] if tile_stats else None)
+    return result, profile, tile_stats
+
+
+def _check_bands(band_data, index_types):
+    """Sprawdza, czy indeksy są znane i czy wgrano wszystkie potrzebne pasma"""
+    for index_type in index_types:
+        if index_type not in INDEX_FORMULAS:
+            st.error(f"Index {index_type} not implemented")
+            return False
+
+    missing_any = False
+    for index_type in index_types:
+        bands_needed = INDEX_FORMULAS[index_type]["bands"]
+        missing = [b for b in bands_needed if b not in band_data]
+        if missing:
+            st.error(f"❌ Missing required bands for {index_type}: {', '.join(missing)}")
+            st.info(f"📋 Please upload: {', '.join(bands_needed)}")
+            missing_any = True
+    return not missing_any
+
+
+def _compute_spectral_index(band_data, bands, index_types, engine, dtype, compact, workers, grid, resampling,
+                            masks, band_cache, pending):
+    """Index stack and per-index tile statistics (or None); safe to run outside the script thread"""
+    tile_stats = None
+    if engine == ENGINE_TILED:
+        with ExitStack() as stack:
+            paths = {b: stack.enter_context(upload_path(band_data[b])) for b in bands}
+            layers = {b: (stack.enter_context(upload_path(band_data[b])), rule) for b, rule in masks.items()}
+            result, tile_stats = compute_indices_tiled(
+                paths, index_types, workers, dtype=dtype, grid=grid, resampling=resampling, masks=layers,
+                compact=compact,
+            )
+    elif engine == ENGINE_STREAMING:
+        with ExitStack() as stack:
+            datasets = {b: stack.enter_context(open_upload(band_data[b])) for b in bands}
+            layers = {b: (stack.enter_context(open_upload(band_data[b])), rule) for b, rule in masks.items()}
+            result = stream_indices(
+                datasets, index_types, dtype=dtype, executor=DECODER, grid=grid, resampling=resampling,
+                masks=layers, compact=compact,
+            )
+    else:
+        decoded = load_bands(
+            {b: band_data[b] for b in bands}, band_cache, pending, grid=grid, resampling=resampling,
+        )
+        # Warstwy maski (klasy SCL, flagi QA) czytane metodą najbliższego sąsiada
+        decoded_masks = load_bands(
+            {b: band_data[b] for b in masks}, band_cache, pending, grid=grid, resampling="nearest",
+        )
+        arrays = {b: decoded[b][0] for b in bands}
+        valid = combine_valid(
+            [decoded[b][2] for b in bands] + [layer_valid(rule, decoded_masks[b][0]) for b, rule in masks.items()]
+        )
+        result = compute_indices_masked(index_types, arrays, valid, dtype=dtype, compact=compact)
+    return result, tile_stats
+
 
-    missing = [b for b in required_bands if b not in band_data]
+def resolve_masks(band_data, mask_options):
+    """Cloud-mask rules (band -> rule) for the enabled options whose mask band was uploaded"""
+    rules = mask_rules(**mask_options)
+    missing = [b for b in rules if b not in band_data]
     if missing:
-        st.error(f"❌ Missing required bands for {index_type}: {', '.join(missing)}")
-        st.info(f"📋 Please upload: {', '.join(required_bands)}")
+        st.warning(f"☁️ Cloud masking skipped for missing band(s): {', '.join(missing)}")
+    return {b: rule for b, rule in rules.items() if b in band_data}
+
+
+def _needs_preview(band_data, index_type, engine_options):
+    """Czy pełna siatka jest większa niż płótno mapy (wtedy podgląd ma sens)"""
+    bands = INDEX_FORMULAS.get(index_type, {}).get("bands", [])
+    if not bands or any(b not in band_data for b in bands):
+        return False
+    grid, _ = _resolve_grid(band_data, bands, engine_options["grid_mode"], engine_options["grid_resolution"])
+    return preview_grid(grid) != grid
+
+
+def compute_preview(band_data, index_type, masks=None, grid_mode=GRID_FINEST, grid_resolution=None, **_):
+    """Index read at display resolution (decimated, overview-aware), shaped like the 'index' stage.
+
+    Reads run on ``PREVIEW_READER``, so they do not queue behind full-resolution decodes.
+    """
+    if not _check_bands(band_data, [index_type]):
         return None
+    bands = INDEX_FORMULAS[index_type]["bands"]
+    grid, profile = _resolve_grid(band_data, bands, grid_mode, grid_resolution)
+    small = preview_grid(grid)
+
+    with ExitStack() as stack:
+        datasets = {b: stack.enter_context(open_upload(band_data[b])) for b in bands}
+        layers = {b: (stack.enter_context(open_upload(band_data[b])), rule) for b, rule in (masks or {}).items()}
+        result = stream_indices(
+            datasets, [index_type], executor=PREVIEW_READER, grid=small, resampling="average", masks=layers,
+        )
+
+    profile = grid_profile(profile, small)
+    # Skala ręczna (m/px) odnosi się do pikseli pełnej rozdzielczości
+    profile["decimation"] = small.transform.a / grid.transform.a
+    return result[0], profile, None
 
-    arrays = []
-    profile = None
-    for b in required_bands:
-        with rasterio.open(band_data[b]) as src:
-            arrays.append(src.read(1).astype(float))
-            if profile is None:
-                profile = src.profile
 
-    index_array = formula(*arrays)
-    index_array = np.clip(index_array, -1, 1)
-    return index_array, profile
+def compute_statistics(index_array, moments=None, progress=None):
+    """Statystyki indeksu w jednym przebiegu blokowym; gotowe momenty z kafli (silnik wielordzeniowy) pomijają przebieg.
 
+    ``progress`` receives sampled estimates with confidence intervals while the pass runs.
+    """
+    if moments is None:
+        if progress is None:
+            moments = array_stats(index_array)
+        else:
+            moments = progressive_array_stats(index_array, progress)
+    return summarize_stats(moments)
 
-def display_statistics(index_array, index_type):
-    st.markdown("### 📈 Statistical Summary")
-    valid = index_array[~np.isnan(index_array)]
+
+def display_statistics(stats, index_type):
+    exact = stats.get("exact", True)
+    st.markdown("### 📈 Statistical Summary" if exact else "### 📈 Statistical Summary (estimate)")
+    prefix = "" if exact else "≈ "
     col1, col2, col3, col4, col5 = st.columns(5)
-    with col1: st.metric("Mean", f"{np.mean(valid):.4f}")
-    with col2: st.metric("Median", f"{np.median(valid):.4f}")
-    with col3: st.metric("Std Dev", f"{np.std(valid):.4f}")
-    with col4: st.metric("Min", f"{np.min(valid):.4f}")
-    with col5: st.metric("Max", f"{np.max(valid):.4f}")
+    with col1: st.metric("Mean", f"{prefix}{stats['mean']:.4f}")
+    with col2: st.metric("Median", f"{prefix}{stats['median']:.4f}")
+    with col3: st.metric("Std Dev", f"{prefix}{stats['std']:.4f}")
+    with col4: st.metric("Min", f"{prefix}{stats['min']:.4f}")
+    with col5: st.metric("Max", f"{prefix}{stats['max']:.4f}")
+    if exact:
+        st.caption(
+            f"{stats['count']:,} valid pixels · {stats['masked_pct']:.1f}% masked (nodata / clouds) · "
+            f"P10 {stats['p10']:.4f} · P25 {stats['p25']:.4f} · "
+            f"P75 {stats['p75']:.4f} · P90 {stats['p90']:.4f} "
+            f"(median and percentiles from a {HIST_BINS}-bin histogram)"
+        )
+    else:
+        low, high = stats["median_ci"]
+        # Bez przedziału ufności (za mała próba) podpis go pomija zamiast pokazywać "nan"
+        ci = "" if np.isnan(stats["mean_ci"]) else (
+            f"95% CI: mean ± {stats['mean_ci']:.4f}, median {low:.4f} – {high:.4f} · "
+        )
+        st.caption(
+            f"⏳ Estimated from {stats['scanned']:.1%} of the raster · ≈ {stats['masked_pct']:.1f}% masked · "
+            f"{ci}min/max are sample bounds. Exact values follow."
+        )
     st.markdown("---")
 
 
+def _show_statistics(panel, stats, index_type):
+    """Podmienia zawartość panelu statystyk (szacunek albo wartości dokładne)"""
+    with panel.container():
+        display_statistics(stats, index_type)
+
+
+def _format_bytes(nbytes):
+    return f"{nbytes / 1024 ** 3:.2f} GB" if nbytes >= 1024 ** 3 else f"{nbytes / 1024 ** 2:.0f} MB"
+
+
 def _format_distance_exact(meters: float) -> str:
     """Formatuje dokładną wartość bez zaokrągleń (2 miejsca po przecinku)"""
     if meters >= 1000:
@@ -327,182 +782,194 @@ def _get_meters_per_pixel(profile, scale_mode: str, manual_m_per_px: float) -> f
     t = profile.get("transform", None)
     crs = profile.get("crs", None)
     if scale_mode == "Manual (meters per pixel)":
-        return float(manual_m_per_px)
+        return float(manual_m_per_px) * profile.get("decimation", 1.0)
 
     if crs is None or getattr(crs, "is_geographic", False) or t is None:
-        return float(manual_m_per_px)
+        return float(manual_m_per_px) * profile.get("decimation", 1.0)
 
     px_x = abs(t.a)
     px_y = abs(t.e)
     return float((px_x + px_y) / 2.0)
 
 
+# Pozycje elementów legendy (jednostki figury)
+LEGEND_LEFT, LEGEND_BOTTOM = 0.01, 0.01
+LEGEND_WIDTH, LEGEND_HEIGHT = 0.28, 0.20
+
+
 def visualize_index_pixel_space(index_array, profile, index_type, colormap, reverse_cmap,
                                 map_title, show_scale, show_north, show_legend,
-                                scale_mode, manual_m_per_px, scale_bar_percentage):
-    """Render w pikselach, pasek skali wypełnia % legend box, bez zaokrągleń"""
-    st.markdown("### 🎨 Index Visualization")
+                                scale_mode, manual_m_per_px, scale_bar_percentage, scale=1,
+                                image_format="PNG", raster=None, layer_cache=None):
+    """Render w pikselach (bajty obrazu), pasek skali wypełnia % legend box, bez zaokrągleń.
+
+    The raster layer (``raster``, rendered here when None) is composited with the
+    decoration layers; each decoration is cached by its own parameters, so e.g. a
+    title edit redraws only the title. ``scale`` multiplies the canvas resolution.
+    Background threads pass ``layer_cache`` because they cannot reach the session.
+    """
+    size = (CANVAS_SIZE[0] * scale, CANVAS_SIZE[1] * scale)
+    if raster is None:
+        raster = raster_layer(index_array, colormap, reverse_cmap, scale)
+
+    w = index_array.shape[1]
+    m_per_px = _get_meters_per_pixel(profile, scale_mode, manual_m_per_px)
+    crs_info = str(profile.get("crs", "N/A"))
+    if len(crs_info) > 40:
+        crs_info = crs_info[:40] + "..."
 
-    fig = plt.figure(figsize=(20, 14), dpi=150, facecolor="white")
-    ax = fig.add_axes([0, 0, 1, 1])
+    specs = [("frame", _draw_legend_frame, ()), ("title", _draw_title, (map_title,))]
+    if show_legend:
+        specs.append(("colorbar", _draw_colorbar, (index_type, colormap, reverse_cmap)))
+    if show_scale:
+        specs.append(("scale", _draw_scale_bar, (w, m_per_px, scale_bar_percentage)))
+    if show_north:
+        specs.append(("north", _draw_north_arrow, ()))
+    # Metadane pokazują rozdzielczość produktu; zdecymowany podgląd tylko jako dopisek (pasek skali go używa)
+    decimation = profile.get("decimation", 1.0)
+    preview_m_per_px = m_per_px if decimation > 1 else None
+    specs.append(("metadata", _draw_metadata,
+                  (crs_info, m_per_px / decimation, "Manual" in scale_mode, preview_m_per_px)))
 
-    cmap = plt.cm.get_cmap(colormap)
-    if reverse_cmap:
-        cmap = cmap.reversed()
+    cache = layer_cache if layer_cache is not None else session_cache("layers", LAYER_CACHE_BYTES)
+    layers = [(raster, (0, 0))]
+    layers += [decoration_layer(cache, name, draw, args, scale) for name, draw, args in specs]
+    return encode_image(composite(layers, size=size), image_format)
 
-    h, w = index_array.shape
 
-    ax.imshow(
-        index_array,
-        cmap=cmap,
-        vmin=-1, vmax=1,
-        interpolation="bilinear",
-        origin="upper",
-        extent=(0, w, h, 0),
-        aspect="auto",
-    )
-    ax.axis("off")
+def raster_layer(index_array, colormap, reverse_cmap, scale=1):
+    """RGBA array of the coloured index stretched over the canvas"""
+    size = (CANVAS_SIZE[0] * scale, CANVAS_SIZE[1] * scale)
+    return np.asarray(render_raster(index_array, colormap, reverse_cmap, size=size))
 
-    # LEGEND BOX
-    legend_left, legend_bottom = 0.01, 0.01
-    legend_width, legend_height = 0.28, 0.20
 
+def _draw_legend_frame(fig):
     legend_bg = Rectangle(
-        (legend_left, legend_bottom), legend_width, legend_height,
+        (LEGEND_LEFT, LEGEND_BOTTOM), LEGEND_WIDTH, LEGEND_HEIGHT,
         transform=fig.transFigure,
         facecolor="white", alpha=1.0,
         edgecolor="black", linewidth=3, zorder=10,
     )
     fig.patches.append(legend_bg)
 
+
+def _draw_title(fig, map_title):
     fig.text(
-        legend_left + legend_width / 2,
-        legend_bottom + legend_height - 0.02,
+        LEGEND_LEFT + LEGEND_WIDTH / 2,
+        LEGEND_BOTTOM + LEGEND_HEIGHT - 0.02,
         map_title,
         ha="center", va="top",
         fontsize=20, fontweight="bold",
         transform=fig.transFigure, zorder=11,
     )
 
-    # COLORBAR
-    if show_legend:
-        cbar_left = legend_left + 0.025
-        cbar_bottom = legend_bottom + 0.09
-        cbar_width = legend_width - 0.05
-        cbar_height = 0.04
-
-        cbar_ax = fig.add_axes([cbar_left, cbar_bottom, cbar_width, cbar_height], zorder=12)
-
-        gradient_data = np.linspace(-1, 1, 256).reshape(1, -1)
-        gradient_x = np.linspace(-1, 1, 257)
-        gradient_y = [0, 1]
-
-        cbar_ax.pcolormesh(gradient_x, gradient_y, gradient_data, cmap=cmap, shading="auto", vmin=-1, vmax=1)
-        cbar_ax.set_xlim(-1, 1)
-        cbar_ax.set_ylim(0, 1)
-        cbar_ax.set_yticks([])
-        cbar_ax.set_xticks([-1, -0.5, 0, 0.5, 1])
-        cbar_ax.set_xticklabels(["-1.0", "-0.5", "0.0", "0.5", "1.0"], fontsize=11, fontweight="bold")
-        cbar_ax.tick_params(axis="x", which="both", length=6, width=2, direction="out",
-                            bottom=True, top=False, labelbottom=True, labeltop=False)
-        for spine in cbar_ax.spines.values():
-            spine.set_edgecolor("black")
-            spine.set_linewidth(2.5)
-            spine.set_visible(True)
-
-        fig.text(
-            cbar_left + cbar_width / 2,
-            cbar_bottom + cbar_height + 0.012,
-            f"{index_type} Value",
-            ha="center", va="bottom",
-            fontsize=13, fontweight="bold",
-            transform=fig.transFigure, zorder=13,
-        )
 
-    # SCALE BAR (SZEROKI I DOKŁADNY)
-    if show_scale:
-        m_per_px = _get_meters_per_pixel(profile, scale_mode, manual_m_per_px)
-        map_width_m = w * m_per_px
-
-        # dostępna przestrzeń w legend box (jak colorbar)
-        available_width_fig = legend_width - 0.05
-
-        # użyj X% tej przestrzeni (parametr użytkownika)
-        scale_bar_width_fig = available_width_fig * (scale_bar_percentage / 100.0)
-
-        # ile metrów reprezentuje ten pasek?
-        # pasek zajmuje scale_bar_width_fig z całkowitej figury, ale mapa ma szerokość w (pikseli)
-        # więc proporcja: (scale_bar_width_fig / (całkowita_szerokość_figury)) ≈ ???
-        # ale łatwiej: jeśli pasek ma być X% dostępnego, weźmy odpowiednią część mapy
-        # np. skala wypełnia 90% legend_box → niech odpowiada ~20-30% szerokości mapy (w metrach)
-
-        # ALTERNATYWNIE: użyjmy bezpośrednio – niech pasek *zawsze* wypełnia % legend_box
-        # i pokazuje rzeczywistą odległość proporcjonalną do jego szerokości na figurze
-        # vs. szerokości obrazu (w).
-
-        # Proporcja: scale_bar_width_fig (jednostki figury) to jaka część całej szerokości obrazu?
-        # Obraz zajmuje 100% figury (ax=[0,0,1,1]), więc 1.0 jednostki figury = w pikseli mapy.
-        # Więc: scale_bar_width_fig jednostek figury = scale_bar_width_fig * w pikseli mapy.
-        # A to w metrach: scale_bar_width_fig * w * m_per_px.
-
-        scale_bar_meters = scale_bar_width_fig * w * m_per_px
-        label = _format_distance_exact(scale_bar_meters)
-
-        scale_bar_left = legend_left + 0.025
-        scale_bar_bottom = legend_bottom + 0.03
-        scale_bar_height = 0.025
-
-        # czarno-biały pasek (2 segmenty)
-        black_seg = Rectangle(
-            (scale_bar_left, scale_bar_bottom),
-            scale_bar_width_fig / 2, scale_bar_height,
-            transform=fig.transFigure,
-            facecolor="black", edgecolor="black", linewidth=2, zorder=12,
-        )
-        fig.patches.append(black_seg)
+def _draw_colorbar(fig, index_type, colormap, reverse_cmap):
+    cmap = plt.cm.get_cmap(colormap)
+    if reverse_cmap:
+        cmap = cmap.reversed()
 
-        white_seg = Rectangle(
-            (scale_bar_left + scale_bar_width_fig / 2, scale_bar_bottom),
-            scale_bar_width_fig / 2, scale_bar_height,
-            transform=fig.transFigure,
-            facecolor="white", edgecolor="black", linewidth=2, zorder=12,
-        )
-        fig.patches.append(white_seg)
+    cbar_left = LEGEND_LEFT + 0.025
+    cbar_bottom = LEGEND_BOTTOM + 0.09
+    cbar_width = LEGEND_WIDTH - 0.05
+    cbar_height = 0.04
+
+    cbar_ax = fig.add_axes([cbar_left, cbar_bottom, cbar_width, cbar_height], zorder=12)
+
+    gradient_data = np.linspace(-1, 1, 256).reshape(1, -1)
+    gradient_x = np.linspace(-1, 1, 257)
+    gradient_y = [0, 1]
+
+    cbar_ax.pcolormesh(gradient_x, gradient_y, gradient_data, cmap=cmap, shading="auto", vmin=-1, vmax=1)
+    cbar_ax.set_xlim(-1, 1)
+    cbar_ax.set_ylim(0, 1)
+    cbar_ax.set_yticks([])
+    cbar_ax.set_xticks([-1, -0.5, 0, 0.5, 1])
+    cbar_ax.set_xticklabels(["-1.0", "-0.5", "0.0", "0.5", "1.0"], fontsize=11, fontweight="bold")
+    cbar_ax.tick_params(axis="x", which="both", length=6, width=2, direction="out",
+                        bottom=True, top=False, labelbottom=True, labeltop=False)
+    for spine in cbar_ax.spines.values():
+        spine.set_edgecolor("black")
+        spine.set_linewidth(2.5)
+        spine.set_visible(True)
 
-        # ETYKIETY (0 i pełna wartość)
-        label_y = scale_bar_bottom - 0.012
-        fig.text(scale_bar_left, label_y, "0",
-                 ha="left", va="top", fontsize=12, fontweight="bold",
-                 transform=fig.transFigure, zorder=13)
+    fig.text(
+        cbar_left + cbar_width / 2,
+        cbar_bottom + cbar_height + 0.012,
+        f"{index_type} Value",
+        ha="center", va="bottom",
+        fontsize=13, fontweight="bold",
+        transform=fig.transFigure, zorder=13,
+    )
 
-        fig.text(scale_bar_left + scale_bar_width_fig, label_y, label,
-                 ha="right", va="top", fontsize=12, fontweight="bold",
-                 transform=fig.transFigure, zorder=13)
 
-    # NORTH ARROW
-    if show_north:
-        north_x, north_y, north_size = 0.945, 0.92, 0.045
-        north_ax = fig.add_axes([north_x, north_y, north_size, north_size * 1.5])
+def _draw_scale_bar(fig, w, m_per_px, scale_bar_percentage):
+    """Pasek skali (szeroki i dokładny)"""
+    # dostępna przestrzeń w legend box (jak colorbar), z czego pasek zajmuje X%
+    available_width_fig = LEGEND_WIDTH - 0.05
+    scale_bar_width_fig = available_width_fig * (scale_bar_percentage / 100.0)
 
-        arrow = FancyArrow(
-            0.5, 0.1, 0, 0.7, width=0.3,
-            head_width=0.5, head_length=0.15,
-            facecolor="black", edgecolor="white", linewidth=3,
-        )
-        north_ax.add_patch(arrow)
-
-        north_ax.text(
-            0.5, 0.95, "N",
-            ha="center", va="center",
-            fontsize=26, fontweight="bold", color="black",
-            bbox=dict(boxstyle="circle,pad=0.3", facecolor="white",
-                      alpha=1.0, edgecolor="black", linewidth=2.5),
-        )
-        north_ax.set_xlim(0, 1)
-        north_ax.set_ylim(0, 1)
-        north_ax.axis("off")
+    # Obraz zajmuje 100% figury, więc 1.0 jednostki figury = w pikseli mapy,
+    # a scale_bar_width_fig jednostek figury = scale_bar_width_fig * w * m_per_px metrów.
+    scale_bar_meters = scale_bar_width_fig * w * m_per_px
+    label = _format_distance_exact(scale_bar_meters)
+
+    scale_bar_left = LEGEND_LEFT + 0.025
+    scale_bar_bottom = LEGEND_BOTTOM + 0.03
+    scale_bar_height = 0.025
+
+    # czarno-biały pasek (2 segmenty)
+    black_seg = Rectangle(
+        (scale_bar_left, scale_bar_bottom),
+        scale_bar_width_fig / 2, scale_bar_height,
+        transform=fig.transFigure,
+        facecolor="black", edgecolor="black", linewidth=2, zorder=12,
+    )
+    fig.patches.append(black_seg)
+
+    white_seg = Rectangle(
+        (scale_bar_left + scale_bar_width_fig / 2, scale_bar_bottom),
+        scale_bar_width_fig / 2, scale_bar_height,
+        transform=fig.transFigure,
+        facecolor="white", edgecolor="black", linewidth=2, zorder=12,
+    )
+    fig.patches.append(white_seg)
+
+    # ETYKIETY (0 i pełna wartość)
+    label_y = scale_bar_bottom - 0.012
+    fig.text(scale_bar_left, label_y, "0",
+             ha="left", va="top", fontsize=12, fontweight="bold",
+             transform=fig.transFigure, zorder=13)
 
-    # METADATA
+    fig.text(scale_bar_left + scale_bar_width_fig, label_y, label,
+             ha="right", va="top", fontsize=12, fontweight="bold",
+             transform=fig.transFigure, zorder=13)
+
+
+def _draw_north_arrow(fig):
+    north_x, north_y, north_size = 0.945, 0.92, 0.045
+    north_ax = fig.add_axes([north_x, north_y, north_size, north_size * 1.5])
+
+    arrow = FancyArrow(
+        0.5, 0.1, 0, 0.7, width=0.3,
+        head_width=0.5, head_length=0.15,
+        facecolor="black", edgecolor="white", linewidth=3,
+    )
+    north_ax.add_patch(arrow)
+
+    north_ax.text(
+        0.5, 0.95, "N",
+        ha="center", va="center",
+        fontsize=26, fontweight="bold", color="black",
+        bbox=dict(boxstyle="circle,pad=0.3", facecolor="white",
+                  alpha=1.0, edgecolor="black", linewidth=2.5),
+    )
+    north_ax.set_xlim(0, 1)
+    north_ax.set_ylim(0, 1)
+    north_ax.axis("off")
+
+
+def _draw_metadata(fig, crs_info, m_per_px, manual, preview_m_per_px=None):
     metadata_left, metadata_bottom = 0.72, 0.01
     metadata_width, metadata_height = 0.27, 0.08
 
@@ -514,16 +981,13 @@ def visualize_index_pixel_space(index_array, profile, index_type, colormap, reve
     )
     fig.patches.append(metadata_bg)
 
-    crs_info = str(profile.get("crs", "N/A"))
-    if len(crs_info) > 40:
-        crs_info = crs_info[:40] + "..."
-
-    m_per_px_used = _get_meters_per_pixel(profile, scale_mode, manual_m_per_px)
     metadata_text = (
         f"Source: Sentinel-2\n"
         f"CRS: {crs_info}\n"
-        f"Scale: {m_per_px_used:.2f} m/px ({'manual' if 'Manual' in scale_mode else 'auto'})"
+        f"Scale: {m_per_px:.2f} m/px ({'manual' if manual else 'auto'})"
     )
+    if preview_m_per_px is not None:
+        metadata_text += f" · preview {preview_m_per_px:.2f} m/px"
 
     fig.text(
         metadata_left + metadata_width / 2,
@@ -534,191 +998,477 @@ def visualize_index_pixel_space(index_array, profile, index_type, colormap, reve
         transform=fig.transFigure, zorder=11,
     )
 
-    st.pyplot(fig, use_container_width=True)
-    st.markdown("---")
-    return fig
 
+def _zone_key(uploaded_vector, profile):
+    return (upload_hash(uploaded_vector), str(profile["crs"]), tuple(profile["transform"]),
+            profile["width"], profile["height"])
 
-def process_vector_analysis(uploaded_vector, index_array, profile, index_type):
-    st.markdown("### 📐 Zonal Statistics")
-    try:
-        temp_raster = tempfile.NamedTemporaryFile(delete=False, suffix=".tif")
-        temp_raster.close()
 
-        profile2 = profile.copy()
-        profile2.update(dtype=rasterio.float32, count=1)
+def zonal_layer(uploaded_vector, profile, zonal_mode=ZONAL_CENTRE):
+    """Features overlapping the raster and their zones, cached per vector upload, output grid and zonal mode.
 
-        with rasterio.open(temp_raster.name, "w", **profile2) as dst:
-            dst.write(index_array.astype(np.float32), 1)
+    The key does not depend on the index or the band files, so every index and
+    every scene computed on the same grid reuses one rasterization (or one set of
+    coverage weights in the area-weighted mode).
+    """
+    cache = session_cache("zones", ZONE_CACHE_BYTES)
+    key = _zone_key(uploaded_vector, profile) + (zonal_mode,)
+    layer = cache.get(key)
+    if layer is None:
+        gdf = read_vector(uploaded_vector, profile)
+        if zonal_mode == ZONAL_WEIGHTED:
+            layer = (gdf, coverage_weights(gdf.geometry, profile))
+        else:
+            layer = (gdf, build_zones(gdf.geometry, profile))
+        cache.put(key, layer)
+    return layer
+
+
+def compute_zonal_statistics(uploaded_vector, index_stack, profile, names, zonal_mode=ZONAL_CENTRE):
+    """Statystyki strefowe wszystkich indeksów wsadu: jedna (cache'owana) rasteryzacja, jeden przebieg na indeks"""
+    gdf, zones = zonal_layer(uploaded_vector, profile, zonal_mode)
+    stats_df = gdf.drop(columns=gdf.geometry.name)
+    for i, name in enumerate(names):
+        if zonal_mode == ZONAL_WEIGHTED:
+            stats = weighted_zonal_table(zones, index_stack[i])
+        else:
+            stats = zonal_table(zones, index_stack[i])
+            stats.update(histogram_columns(stats.pop("histogram")))
+        prefix = f"{name}_" if len(names) > 1 else ""
+        for column, values in stats.items():
+            stats_df[prefix + column] = values
+    return stats_df
 
-        gdf = gpd.read_file(io.BytesIO(uploaded_vector.getvalue()))
 
+def process_vector_analysis(run, batch_indices):
+    """Zonal statistics table and CSV download; returns the statistics (None when the zonal stage failed)"""
+    st.markdown("### 📐 Zonal Statistics")
+    stats_df = None
+    try:
         with st.spinner("Calculating zonal statistics..."):
-            stats = zonal_stats(
-                gdf,
-                temp_raster.name,
-                stats=["mean", "min", "max", "std", "count"],
-                geojson_out=True,
-            )
+            stats_df = run.value("zonal")
 
-        stats_gdf = gpd.GeoDataFrame.from_features(stats)
-        st.success(f"✅ Calculated statistics for {len(stats_gdf)} features")
-        st.dataframe(stats_gdf.drop("geometry", axis=1), use_container_width=True, height=300)
+        st.success(f"✅ Calculated {', '.join(batch_indices)} statistics for {len(stats_df)} features")
+        st.dataframe(stats_df, use_container_width=True, height=300)
 
-        csv = stats_gdf.drop("geometry", axis=1).to_csv(index=False)
+        csv = stats_df.to_csv(index=False)
         st.download_button(
             label="📥 Download Zonal Statistics CSV",
             data=csv,
-            file_name=f"{index_type}_zonal_stats.csv",
+            file_name=f"{'_'.join(batch_indices)}_zonal_stats.csv",
             mime="text/csv",
         )
 
         st.markdown("---")
-        os.unlink(temp_raster.name)
 
     except Exception as e:
         st.error(f"Error in zonal statistics: {str(e)}")
         st.exception(e)
+    return stats_df
+
+
+class LocalTileLayer(folium.TileLayer):
+    """Tile layer of the local tile server; the server address is resolved in the browser (``tile_origin``)"""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.tileLayer(
+                ({{ this.origin|tojson }} || location.protocol + "//" + location.hostname + ":" + {{ this.port }})
+                    + {{ this.tiles|tojson }},
+                {{ this.leaflet_options|tojson }}
+            );
+        {% endmacro %}
+    """)
+
+    def __init__(self, tiles, origin, **kwargs):
+        super().__init__(tiles=tiles, **kwargs)
+        self.origin, self.port = origin
+        self.leaflet_options = {camelize(k): v for k, v in self.options.items()}
+
+
+class ZoomOverlay(MacroElement):
+    """Choropleth loaded into ``group`` from a local endpoint: the simplified level of the current zoom, viewport only"""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var map = {{ this._parent.get_name() }};
+            var group = {{ this.group.get_name() }};
+            var zooms = {{ this.zooms|tojson }};
+            var url = ({{ this.origin|tojson }} || location.protocol + "//" + location.hostname + ":" + {{ this.port }})
+                + {{ this.url|tojson }};
+            var label = {{ this.label|tojson }};
+            var loaded = null, request = 0;
+            function level(z) {
+                var l = zooms[0];
+                zooms.forEach(function(v) { if (v <= z) { l = v; } });
+                return l;
+            }
+            function load() {
+                var z = level(map.getZoom()), view = map.getBounds();
+                if (loaded && loaded.z === z && loaded.bounds.contains(view)) { return; }
+                var bounds = view.pad(0.5), id = ++request;
+                var bbox = [bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()].join(",");
+                fetch(url.replace("{z}", z) + "?bbox=" + bbox)
+                    .then(function(r) { return r.json(); })
+                    .then(function(data) {
+                        if (id !== request) { return; }
+                        loaded = {z: z, bounds: bounds};
+                        group.clearLayers();
+                        L.geoJSON(data, {
+                            style: function(f) {
+                                var c = f.properties.c;
+                                return {color: c || "#808080", weight: 0.5, fillColor: c || "#808080",
+                                        fillOpacity: c ? 0.75 : 0.0};
+                            }
+                        }).bindTooltip(function(layer) {
+                            var v = layer.feature.properties.v;
+                            return label + ": " + (v === null ? "no data" : v.toFixed(3));
+                        }).addTo(group);
+                    });
+            }
+            map.on("moveend", load);
+            load();
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, url, group, label, origin, zooms=OVERLAY_ZOOMS):
+        super().__init__()
+        self._name = "ZoomOverlay"
+        self.url = url
+        self.origin, self.port = origin
+        self.group = group
+        self.label = label
+        self.zooms = list(zooms)
+
+
+def build_interactive_map(profile, index_type, tiles=None, overlay=None):
+    """Folium map of the raster footprint.
+
+    ``tiles`` is the URL path template of the index overlay and ``overlay`` the one
+    of the zonal choropleth (both served by the local tile server).
+    """
+    bounds = raster_footprint(profile)
+    if profile.get("crs") is not None:
+        # Folium oczekuje lat/lon, a granice rastra są w jego (zwykle metrycznym) CRS
+        bounds = transform_bounds(profile["crs"], "EPSG:4326", *bounds, densify_pts=21)
+    center_lat = (bounds[1] + bounds[3]) / 2.0
+    center_lon = (bounds[0] + bounds[2]) / 2.0
+
+    m = folium.Map(
+        location=[center_lat, center_lon],
+        zoom_start=13,
+        tiles="OpenStreetMap",
+        prefer_canvas=True,
+    )
 
+    folium.TileLayer(
+        tiles="CartoDB positron",
+        name="Light",
+        attr='&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors &copy; <a href="https://carto.com/attributions">CARTO</a>',
+    ).add_to(m)
+
+    folium.TileLayer(
+        tiles="CartoDB dark_matter",
+        name="Dark",
+        attr='&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors &copy; <a href="https://carto.com/attributions">CARTO</a>',
+    ).add_to(m)
+
+    folium.TileLayer(
+        tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
+        attr="Esri",
+        name="Satellite",
+        overlay=False,
+        control=True,
+    ).add_to(m)
+
+    folium.TileLayer(
+        tiles="https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}",
+        attr="Google",
+        name="Google Hybrid",
+        overlay=False,
+        control=True,
+    ).add_to(m)
+
+    if tiles is not None:
+        LocalTileLayer(
+            tiles,
+            tile_origin(),
+            attr="INVISTERRA",
+            name=index_type,
+            overlay=True,
+            control=True,
+            opacity=0.85,
+            max_zoom=22,
+        ).add_to(m)
 
-def create_interactive_map(index_array, profile, index_type):
+    if overlay is not None:
+        group = folium.FeatureGroup(name=f"{index_type} zonal mean", overlay=True, control=True).add_to(m)
+        ZoomOverlay(overlay, group, f"{index_type} mean", tile_origin()).add_to(m)
+
+    folium.Rectangle(
+        bounds=[[bounds[1], bounds[0]], [bounds[3], bounds[2]]],
+        color="#FF0000",
+        weight=4,
+        fill=tiles is None,
+        fillColor="#FF0000",
+        fillOpacity=0.1,
+        popup=f"{index_type} Coverage Area",
+    ).add_to(m)
+
+    folium.Marker(
+        [center_lat, center_lon],
+        popup=folium.Popup(f"<b>{index_type} Analysis Center</b>", max_width=200),
+        tooltip=f"{index_type}",
+        icon=folium.Icon(color="red", icon="map", prefix="fa"),
+    ).add_to(m)
+
+    folium.CircleMarker(
+        [bounds[1], bounds[0]], radius=5, color="blue", fill=True, popup="SW Corner"
+    ).add_to(m)
+
+    folium.CircleMarker(
+        [bounds[3], bounds[2]], radius=5, color="blue", fill=True, popup="NE Corner"
+    ).add_to(m)
+
+    folium.LayerControl(position="topright").add_to(m)
+    return m
+
+
+def zonal_overlay(run, index):
+    """URL template of the zonal-mean choropleth of the shown index (levels are prepared once per vector layer)"""
+    stats_df = run.value("zonal")
+    if stats_df is None:
+        return None
+    uploaded_vector, index_type = run.params["uploaded_vector"], run.params["index_type"]
+    profile = index[1]
+    column = f"{index_type}_mean" if len(run.params["batch_indices"]) > 1 else "mean"
+    gdf, _ = zonal_layer(uploaded_vector, profile, run.params["zonal_mode"])
+    layer_key = content_hash(repr(_zone_key(uploaded_vector, profile)).encode("utf-8"))
+    key = content_hash("|".join(
+        [run.fingerprint("zonal"), index_type, run.params["colormap"], str(run.params["reverse_cmap"])]
+    ).encode("utf-8"))
+    return overlay_url(layer_key, gdf.geometry, key, stats_df[column].to_numpy(dtype=np.float64),
+                       run.params["colormap"], run.params["reverse_cmap"])
+
+
+def create_interactive_map(run, show_zonal=False):
     st.markdown("### 🗺️ Interactive Map")
     try:
-        bounds = rasterio.transform.array_bounds(profile["height"], profile["width"], profile["transform"])
-        center_lat = (bounds[1] + bounds[3]) / 2.0
-        center_lon = (bounds[0] + bounds[2]) / 2.0
-
-        m = folium.Map(
-            location=[center_lat, center_lon],
-            zoom_start=13,
-            tiles="OpenStreetMap",
-            prefer_canvas=True,
-        )
+        # Źródło kafli jest rejestrowane przy każdym rerunie (mogło wypaść z LRU serwera);
+        # odcisk wyniku jako klucz sprawia, że gotowe kafle są współdzielone między rerunami.
+        # Sama mapa folium to tylko kilka warstw z adresami - budowana co rerun, poza cache etapów,
+        # więc zawsze pokazuje aktualną warstwę wektorową i tryb stref
+        index = run.value("index")
+        tiles = tile_url(run.fingerprint("index"), index[0], index[1],
+                         run.params["colormap"], run.params["reverse_cmap"])
+        overlay = None
+        if show_zonal:
+            # Błąd warstwy wektorowej nie może zabrać mapy indeksu
+            try:
+                overlay = zonal_overlay(run, index)
+            except Exception as e:
+                st.warning(f"⚠️ The zonal layer could not be added to the map: {str(e)}")
+        m = build_interactive_map(index[1], run.params["index_type"], tiles, overlay)
+        st_folium(m, width=1400, height=700, returned_objects=[])
+        st.markdown("---")
 
-        folium.TileLayer(
-            tiles="CartoDB positron",
-            name="Light",
-            attr='&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors &copy; <a href="https://carto.com/attributions">CARTO</a>',
-        ).add_to(m)
+    except Exception as e:
+        st.error(f"❌ Could not create interactive map: {str(e)}")
+        st.exception(e)
 
-        folium.TileLayer(
-            tiles="CartoDB dark_matter",
-            name="Dark",
-            attr='&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors &copy; <a href="https://carto.com/attributions">CARTO</a>',
-        ).add_to(m)
 
-        folium.TileLayer(
-            tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
-            attr="Esri",
-            name="Satellite",
-            overlay=False,
-            control=True,
-        ).add_to(m)
+def geotiff_export(index_stack, profile, names, export_options):
+    """Cloud-Optimized GeoTIFF bytes of a resident index or index stack (names become band descriptions).
 
-        folium.TileLayer(
-            tiles="https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}",
-            attr="Google",
-            name="Google Hybrid",
-            overlay=False,
-            control=True,
-        ).add_to(m)
+    The file is written tile by tile straight from the array.
+    """
+    # Wynik kompaktowy jest zapisywany jako int16 ze współczynnikiem skali 1e-4
+    storage = dict(dtype="int16", nodata=INDEX_NODATA, scale=1.0 / INDEX_SCALE) if is_compact(index_stack) else {}
+    return cog_bytes(profile, len(names), partial(write_array_blocks, array=index_stack), names=names,
+                     **storage, **export_options)
 
-        folium.Rectangle(
-            bounds=[[bounds[1], bounds[0]], [bounds[3], bounds[2]]],
-            color="#FF0000",
-            weight=4,
-            fill=True,
-            fillColor="#FF0000",
-            fillOpacity=0.1,
-            popup=f"{index_type} Coverage Area",
-        ).add_to(m)
 
-        folium.Marker(
-            [center_lat, center_lon],
-            popup=folium.Popup(f"<b>{index_type} Analysis Center</b>", max_width=200),
-            tooltip=f"{index_type}",
-            icon=folium.Icon(color="red", icon="map", prefix="fa"),
-        ).add_to(m)
+def statistics_report(stats, index_type):
+    """Raport TXT ze statystykami indeksu"""
+    return f"""{index_type} STATISTICS REPORT
+{'=' * 60}
+Mean:   {stats['mean']:.6f}
+Median: {stats['median']:.6f}
+Std:    {stats['std']:.6f}
+Min:    {stats['min']:.6f}
+Max:    {stats['max']:.6f}
+P10:    {stats['p10']:.6f}
+P25:    {stats['p25']:.6f}
+P75:    {stats['p75']:.6f}
+P90:    {stats['p90']:.6f}
+Valid pixels: {stats['count']}
+Masked: {stats['masked_pct']:.2f}%
+"""
 
-        folium.CircleMarker(
-            [bounds[1], bounds[0]], radius=5, color="blue", fill=True, popup="SW Corner"
-        ).add_to(m)
 
-        folium.CircleMarker(
-            [bounds[3], bounds[2]], radius=5, color="blue", fill=True, popup="NE Corner"
-        ).add_to(m)
+def _build_lazily(job_key, job):
+    """Result of ``job``; with a job key it is built on the background executor (None until it is ready)"""
+    if job_key is None:
+        return job()
+    return _run_in_background(job_key, job)
 
-        folium.LayerControl(position="topright").add_to(m)
 
-        st_folium(m, width=1400, height=700, returned_objects=[])
-        st.markdown("---")
+def _download_button(run, stage, label, file_name, mime):
+    """Przycisk pobierania; plik powstaje dopiero na żądanie. Zwraca True, gdy plik jest jeszcze budowany.
+
+    The request is remembered per stage fingerprint, so the file is rebuilt only when
+    its inputs change; the built bytes live in the pipeline's result cache.
+    """
+    key = (stage, run.fingerprint(stage))
+    requested = st.session_state.setdefault("_requested_downloads", set())
+    if key not in requested:
+        if not st.button(f"⚙️ Prepare {label}", key=f"prepare_{stage}", use_container_width=True):
+            return False
+        requested.add(key)
 
+    try:
+        data = run.value(stage, job_key=key)
     except Exception as e:
-        st.error(f"❌ Could not create interactive map: {str(e)}")
-        st.exception(e)
+        requested.discard(key)
+        st.error(f"Error: {str(e)}")
+        return False
+
+    if data is None:
+        st.button(f"⏳ Preparing {label}...", key=f"preparing_{stage}", disabled=True, use_container_width=True)
+        return True
+    st.download_button(
+        label=f"📥 Download {label}",
+        data=data,
+        file_name=file_name,
+        mime=mime,
+        use_container_width=True,
+        key=f"download_{stage}",
+    )
+    return False
 
 
-def create_download_section(index_array, profile, index_type, fig):
+def create_download_section(run, index_type, batch_indices):
     st.markdown("### 💾 Download Results")
+    st.caption("Files are prepared on request in the background and kept for the current settings.")
+
     col1, col2, col3 = st.columns(3)
+    building = []
 
     with col1:
-        try:
-            temp_output = tempfile.NamedTemporaryFile(delete=False, suffix=".tif")
-            temp_output.close()
-
-            profile2 = profile.copy()
-            profile2.update(dtype=rasterio.float32, count=1, compress="lzw")
-
-            with rasterio.open(temp_output.name, "w", **profile2) as dst:
-                dst.write(index_array.astype(np.float32), 1)
-
-            with open(temp_output.name, "rb") as f:
-                st.download_button(
-                    label="📥 Download GeoTIFF",
-                    data=f.read(),
-                    file_name=f"{index_type}_result.tif",
-                    mime="image/tiff",
-                    use_container_width=True,
-                )
-
-            os.unlink(temp_output.name)
-        except Exception as e:
-            st.error(f"Error: {str(e)}")
+        building.append(_download_button(run, "tif_download", "GeoTIFF", f"{index_type}_result.tif", "image/tiff"))
 
     with col2:
-        try:
-            buf = io.BytesIO()
-            fig.savefig(buf, format="png", dpi=300, bbox_inches="tight", facecolor="white", pad_inches=0)
-            buf.seek(0)
-
-            st.download_button(
-                label="📥 Download PNG (High Quality)",
-                data=buf,
-                file_name=f"{index_type}_visualization_HQ.png",
-                mime="image/png",
-                use_container_width=True,
-            )
-        except Exception as e:
-            st.error(f"Error: {str(e)}")
+        building.append(_download_button(
+            run, "png_download", "PNG (High Quality)", f"{index_type}_visualization_HQ.png", "image/png",
+        ))
 
     with col3:
-        try:
-            valid_data = index_array[~np.isnan(index_array)]
-            stats_text = f"""{index_type} STATISTICS REPORT
-{'=' * 60}
-Mean:   {np.mean(valid_data):.6f}
-Median: {np.median(valid_data):.6f}
-Std:    {np.std(valid_data):.6f}
-Min:    {np.min(valid_data):.6f}
-Max:    {np.max(valid_data):.6f}
-"""
-            st.download_button(
-                label="📥 Download Report (TXT)",
-                data=stats_text,
-                file_name=f"{index_type}_report.txt",
-                mime="text/plain",
-                use_container_width=True,
-            )
-        except Exception as e:
-            st.error(f"Error: {str(e)}")
+        building.append(_download_button(run, "txt_download", "Report (TXT)", f"{index_type}_report.txt",
+                                         "text/plain"))
+
+    if len(batch_indices) > 1:
+        building.append(_download_button(
+            run, "stack_download", f"Multi-index GeoTIFF ({', '.join(batch_indices)})",
+            f"{'_'.join(batch_indices)}_stack.tif", "image/tiff",
+        ))
+
+    if any(building):
+        _await_background_job()
+
+
+# Graf etapów przetwarzania: każdy etap jest przeliczany tylko, gdy zmienią się jego wejścia
+PIPELINE = StageGraph()
+# Maskowanie chmur: reguły są stosowane podczas odczytu pasm w etapach poniżej
+PIPELINE.add("masks", resolve_masks, params=["band_data", "mask_options"], cache=False)
+PIPELINE.add(
+    "indices",
+    lambda masks, band_data, batch_indices, engine_options, background=False:
+        calculate_spectral_index(band_data, list(batch_indices), masks=masks, background=background,
+                                 **engine_options),
+    deps=["masks"],
+    params=["band_data", "batch_indices", "engine_options"],
+)
+# Widok jednego pasma ze stosu wsadowego - tani, więc nie jest cache'owany osobno
+PIPELINE.add(
+    "index",
+    lambda indices, batch_indices, index_type: (
+        indices[0][batch_indices.index(index_type)],
+        indices[1],
+        indices[2][batch_indices.index(index_type)] if indices[2] else None,
+    ),
+    deps=["indices"],
+    params=["batch_indices", "index_type"],
+    cache=False,
+)
+PIPELINE.add(
+    "preview",
+    lambda masks, band_data, index_type, engine_options:
+        compute_preview(band_data, index_type, masks, **engine_options),
+    deps=["masks"],
+    params=["band_data", "index_type", "engine_options"],
+)
+# Mapa jest rysowana z podglądu (szybko) albo z pełnej rozdzielczości
+PIPELINE.switch("display", "preview", {True: "preview", False: "index"})
+PIPELINE.add(
+    "stats",
+    lambda index, progress=None: compute_statistics(index[0], index[2], progress=progress),
+    deps=["index"],
+)
+# Warstwa rastra zależy tylko od danych i palety; dekoracje są cache'owane osobno
+PIPELINE.add(
+    "raster_layer",
+    lambda display, colormap, reverse_cmap: raster_layer(display[0], colormap, reverse_cmap),
+    deps=["display"],
+    params=["colormap", "reverse_cmap"],
+)
+PIPELINE.add(
+    "figure",
+    lambda display, raster_layer, **settings: visualize_index_pixel_space(
+        display[0], display[1], image_format="JPEG", raster=raster_layer, **settings,
+    ),
+    deps=["display", "raster_layer"],
+    params=["index_type", "colormap", "reverse_cmap", "map_title", "show_scale", "show_north",
+            "show_legend", "scale_mode", "manual_m_per_px", "scale_bar_percentage"],
+)
+PIPELINE.add(
+    "zonal",
+    lambda indices, uploaded_vector, batch_indices, zonal_mode:
+        compute_zonal_statistics(uploaded_vector, indices[0], indices[1], list(batch_indices), zonal_mode),
+    deps=["indices"],
+    params=["uploaded_vector", "batch_indices", "zonal_mode"],
+)
+# Pliki do pobrania: budowane tylko na żądanie (runtime job_key), w tle
+PIPELINE.add(
+    "tif_download",
+    lambda index, index_type, export_options, job_key=None:
+        _build_lazily(job_key, partial(geotiff_export, index[0], index[1], [index_type], export_options)),
+    deps=["index"],
+    params=["index_type", "export_options"],
+)
+PIPELINE.add(
+    "stack_download",
+    lambda indices, batch_indices, export_options, job_key=None:
+        _build_lazily(job_key, partial(geotiff_export, indices[0], indices[1], list(batch_indices), export_options)),
+    deps=["indices"],
+    params=["batch_indices", "export_options"],
+)
+# PNG do pobrania: pełna rozdzielczość indeksu, płótno 2x (300 dpi)
+PIPELINE.add(
+    "png_download",
+    lambda index, job_key=None, **settings: _build_lazily(job_key, partial(
+        visualize_index_pixel_space, index[0], index[1], scale=2,
+        layer_cache=session_cache("layers", LAYER_CACHE_BYTES), **settings,
+    )),
+    deps=["index"],
+    params=["index_type", "colormap", "reverse_cmap", "map_title", "show_scale", "show_north",
+            "show_legend", "scale_mode", "manual_m_per_px", "scale_bar_percentage"],
+)
+# Raport jest tani, więc powstaje od razu po kliknięciu
+PIPELINE.add(
+    "txt_download",
+    lambda stats, index_type, job_key=None: statistics_report(stats, index_type),
+    deps=["stats"],
+    params=["index_type"],
+)
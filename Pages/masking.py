@@ -0,0 +1,63 @@
+import numpy as np
+
+
+# Klasy mapy SCL (Sentinel-2 L2A Scene Classification)
+SCL_CLASSES = {
+    0: "No data",
+    1: "Saturated / defective",
+    2: "Dark area pixels",
+    3: "Cloud shadows",
+    4: "Vegetation",
+    5: "Not vegetated",
+    6: "Water",
+    7: "Unclassified",
+    8: "Cloud medium probability",
+    9: "Cloud high probability",
+    10: "Thin cirrus",
+    11: "Snow / ice",
+}
+DEFAULT_SCL_MASK = (0, 1, 3, 8, 9, 10)
+
+# QA60 (L1C): bit 10 = chmury nieprzezroczyste, bit 11 = cirrus
+QA60_CLOUD_BITS = (1 << 10) | (1 << 11)
+
+# Odbicie B10 (cirrus) powyżej progu oznacza cirrus; DN = odbicie * 10000 + przesunięcie
+REFLECTANCE_SCALE = 10000.0
+DEFAULT_CIRRUS_THRESHOLD = 0.012
+# Przesunięcie radiometryczne L1C (RADIO_ADD_OFFSET = -1000) od baseline 04.00 (styczeń 2022); wcześniej 0
+DEFAULT_RADIOMETRIC_OFFSET = 1000.0
+
+MASK_SCL = "scl"
+MASK_CIRRUS = "cirrus"
+MASK_QA = "qa"
+
+# Pasmo źródłowe każdej reguły maskowania
+MASK_BANDS = {MASK_SCL: "SCL", MASK_CIRRUS: "B10", MASK_QA: "QA60"}
+
+
+def mask_rules(scl_classes=(), cirrus_threshold=None, qa_bits=0, radiometric_offset=DEFAULT_RADIOMETRIC_OFFSET):
+    """Mask rules (band -> (kind, parameter)) for the enabled masking options; hashable parameters only.
+
+    ``radiometric_offset`` is the DN offset of the B10 band (1000 for processing baseline 04.00+, 0 before).
+    """
+    rules = {}
+    if scl_classes:
+        rules[MASK_BANDS[MASK_SCL]] = (MASK_SCL, tuple(sorted(int(c) for c in scl_classes)))
+    if cirrus_threshold is not None:
+        rules[MASK_BANDS[MASK_CIRRUS]] = (MASK_CIRRUS, (float(cirrus_threshold), float(radiometric_offset)))
+    if qa_bits:
+        rules[MASK_BANDS[MASK_QA]] = (MASK_QA, int(qa_bits))
+    return rules
+
+
+def layer_valid(rule, array):
+    """Validity (True = keep) of one mask layer block under its rule"""
+    kind, parameter = rule
+    if kind == MASK_SCL:
+        return ~np.isin(array, parameter)
+    if kind == MASK_CIRRUS:
+        threshold, offset = parameter
+        return array < threshold * REFLECTANCE_SCALE + offset
+    if kind == MASK_QA:
+        return (array.astype(np.int64, copy=False) & parameter) == 0
+    raise ValueError(f"Unknown mask rule: {kind}")
@@ -0,0 +1,115 @@
+import hashlib
+import time
+
+from Pages.raster_cache import upload_hash
+
+
+def fingerprint(value) -> str:
+    """Stable fingerprint of a stage input (uploads are identified by their content)"""
+    if hasattr(value, "getbuffer"):
+        return f"upload:{upload_hash(value)}"
+    if isinstance(value, dict):
+        items = sorted((str(k), fingerprint(v)) for k, v in value.items())
+        return "{" + ",".join(f"{k}={v}" for k, v in items) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(fingerprint(v) for v in value) + "]"
+    return f"{type(value).__name__}:{value!r}"
+
+
+class Stage:
+    def __init__(self, name, func, deps=(), params=(), cache=True, cases=None):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.params = tuple(params)
+        self.cache = cache
+        # Stage-przełącznik: wartość jednej z zależności wybranej parametrem
+        self.cases = cases
+
+
+class StageGraph:
+    """Dependency graph of pipeline stages; each stage is keyed by a fingerprint of its inputs"""
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, func, deps=(), params=(), cache=True) -> None:
+        missing = [d for d in deps if d not in self.stages]
+        if missing:
+            raise ValueError(f"Stage {name} depends on unknown stages: {', '.join(missing)}")
+        self.stages[name] = Stage(name, func, deps, params, cache)
+
+    def switch(self, name, param, cases) -> None:
+        """Alias stage that resolves to ``cases[params[param]]`` (value and fingerprint)"""
+        missing = [d for d in cases.values() if d not in self.stages]
+        if missing:
+            raise ValueError(f"Stage {name} depends on unknown stages: {', '.join(missing)}")
+        self.stages[name] = Stage(name, None, tuple(cases.values()), (param,), cache=False, cases=dict(cases))
+
+    def run(self, params, cache):
+        return PipelineRun(self, params, cache)
+
+
+class PipelineRun:
+    """One evaluation of a StageGraph; stages are computed lazily and at most once per run"""
+
+    def __init__(self, graph, params, cache):
+        self.graph = graph
+        self.params = params
+        self.cache = cache
+        self.values = {}
+        self.fingerprints = {}
+        self.report = []
+
+    def _selected(self, stage):
+        return stage.cases[self.params.get(stage.params[0])]
+
+    def fingerprint(self, name) -> str:
+        stage = self.graph.stages[name]
+        if stage.cases is not None:
+            return self.fingerprint(self._selected(stage))
+        if name not in self.fingerprints:
+            parts = [name]
+            parts += [f"{p}={fingerprint(self.params.get(p))}" for p in stage.params]
+            parts += [f"{d}:{self.fingerprint(d)}" for d in stage.deps]
+            digest = hashlib.blake2b("|".join(parts).encode("utf-8"), digest_size=16)
+            self.fingerprints[name] = digest.hexdigest()
+        return self.fingerprints[name]
+
+    def value(self, name, **runtime):
+        """Stage result; runtime kwargs are passed to the stage but not fingerprinted"""
+        if name in self.values:
+            return self.values[name]
+
+        stage = self.graph.stages[name]
+        if stage.cases is not None:
+            self.values[name] = self.value(self._selected(stage), **runtime)
+            return self.values[name]
+
+        key = (name, self.fingerprint(name))
+        started = time.perf_counter()
+
+        result = self.cache.get(key) if stage.cache else None
+        if result is not None:
+            status = "cache hit"
+        else:
+            inputs = {d: self.value(d) for d in stage.deps}
+            started = time.perf_counter()
+            if any(v is None for v in inputs.values()):
+                status = "skipped"
+            else:
+                inputs.update({p: self.params.get(p) for p in stage.params})
+                inputs.update(runtime)
+                result = stage.func(**inputs)
+                status = "computed"
+                if stage.cache and result is not None:
+                    self.cache.put(key, result)
+
+        self.values[name] = result
+        self.report.append({
+            "stage": name,
+            "status": status,
+            "time_ms": round((time.perf_counter() - started) * 1000.0, 1),
+            "fingerprint": key[1][:12],
+        })
+        return result
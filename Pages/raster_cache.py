@@ -0,0 +1,205 @@
+import hashlib
+import itertools
+import logging
+import os
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import streamlit as st
+
+
+logger = logging.getLogger(__name__)
+
+
+def memory_budget(fraction, minimum):
+    """A ``fraction`` of the machine's physical memory in bytes, but at least ``minimum``"""
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return int(minimum)
+    return max(int(total * fraction), int(minimum))
+
+
+# Wspólny limit wszystkich cache'y sesji (pasma, wyniki, strefy, warstwy) w całym procesie;
+# poniższe limity dotyczą pojedynczego cache'a jednej sesji
+SESSION_CACHES_BYTES = int(os.environ.get("INVISTERRA_CACHE_BYTES", 0)) or memory_budget(0.5, 4 * 1024 ** 3)
+BAND_CACHE_BYTES = 2 * 1024 ** 3
+# Wyniki etapów (stos indeksów wsadu, warstwy, figury): pełny kafel S2 to ~482 MB na indeks float32,
+# więc limit rośnie z pamięcią maszyny, żeby wsad przetrwał reruny kosmetyczne
+RESULT_CACHE_BYTES = memory_budget(0.25, 2 * 1024 ** 3)
+PROFILE_CACHE_BYTES = 16 * 1024 ** 2
+LAYER_CACHE_BYTES = 256 * 1024 ** 2
+ZONE_CACHE_BYTES = 512 * 1024 ** 2
+# Serwer kafli jest wspólny dla sesji: źródła (wyniki indeksów) i gotowe kafle PNG
+TILE_SOURCE_BYTES = 2 * 1024 ** 3
+TILE_CACHE_BYTES = 128 * 1024 ** 2
+
+
+def _sizeof(value) -> int:
+    """Approximate memory footprint of a cached value (arrays dominate)"""
+    if isinstance(value, np.ndarray) or isinstance(getattr(value, "nbytes", None), int):
+        return int(value.nbytes)
+    if isinstance(value, (tuple, list)):
+        return sum(_sizeof(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_sizeof(v) for v in value.values())
+    return sys.getsizeof(value)
+
+
+class MemoryBudget:
+    """Byte budget shared by several LRU caches: one lock, one accounting and one recency order.
+
+    When the caches together exceed ``max_bytes``, the least recently used entry
+    of any of them is evicted, so many sessions cannot add up past the budget.
+    """
+
+    def __init__(self, max_bytes: int, name: str = ""):
+        self.max_bytes = int(max_bytes)
+        self.name = name
+        self.nbytes = 0
+        # (token cache'a, klucz) -> (słaba referencja do cache'a, rozmiar), od najdawniej używanych
+        self._order = OrderedDict()
+        self._tokens = itertools.count()
+        self.lock = threading.RLock()
+
+    def register(self, cache) -> int:
+        token = next(self._tokens)
+        # Wpisy cache'a porzuconego razem z sesją przestają się liczyć do budżetu
+        weakref.finalize(cache, self._forget, token)
+        return token
+
+    def add(self, cache, key, size) -> None:
+        with self.lock:
+            self._order[(cache.token, key)] = (weakref.ref(cache), size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes and self._order:
+                (_, oldest), (ref, oldest_size) = self._order.popitem(last=False)
+                self.nbytes -= oldest_size
+                owner = ref()
+                if owner is not None:
+                    owner.pop(oldest)
+
+    def touch(self, cache, key) -> None:
+        with self.lock:
+            self._order.move_to_end((cache.token, key))
+
+    def discard(self, cache, key) -> None:
+        with self.lock:
+            entry = self._order.pop((cache.token, key), None)
+            if entry is not None:
+                self.nbytes -= entry[1]
+
+    def _forget(self, token) -> None:
+        with self.lock:
+            for order_key in [k for k in self._order if k[0] == token]:
+                self.nbytes -= self._order.pop(order_key)[1]
+
+
+SESSION_BUDGET = MemoryBudget(SESSION_CACHES_BYTES, "sessions")
+
+
+class LRUCache:
+    """Memory-bounded, thread-safe LRU cache; the least recently used entries are evicted first.
+
+    With a ``budget`` the cache also counts towards a limit shared with other caches
+    and uses its lock.
+    """
+
+    def __init__(self, max_bytes: int, name: str = "", budget: MemoryBudget = None):
+        self.max_bytes = int(max_bytes)
+        self.name = name
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._budget = budget
+        self._lock = budget.lock if budget is not None else threading.RLock()
+        self.token = budget.register(self) if budget is not None else None
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._entries.move_to_end(key)
+            if self._budget is not None:
+                self._budget.touch(self, key)
+            return entry[0]
+
+    def put(self, key, value) -> None:
+        size = _sizeof(value)
+        with self._lock:
+            self.pop(key)
+            limit = self.max_bytes if self._budget is None else min(self.max_bytes, self._budget.max_bytes)
+            if size > limit:
+                logger.warning(
+                    "%s cache: entry of %.0f MiB exceeds the %.0f MiB budget and is not cached",
+                    self.name or "LRU", size / 1024 ** 2, limit / 1024 ** 2,
+                )
+                return
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                self.pop(next(iter(self._entries)))
+            if self._budget is not None:
+                self._budget.add(self, key, size)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self.nbytes -= entry[1]
+            if self._budget is not None:
+                self._budget.discard(self, key)
+            return entry[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._entries):
+                self.pop(key)
+
+
+def content_hash(data) -> str:
+    """Hash of raw bytes (bytes, bytearray or memoryview)"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+# file_id -> hash; file_id uploadu jest unikalny, więc memo może być wspólne dla sesji i wątków
+_UPLOAD_HASHES = OrderedDict()
+_UPLOAD_HASHES_MAX = 4096
+_UPLOAD_HASHES_LOCK = threading.Lock()
+
+
+def upload_hash(uploaded_file) -> str:
+    """Content hash of a Streamlit upload, memoized per upload so reruns do not rehash (thread-safe)"""
+    file_id = getattr(uploaded_file, "file_id", None)
+    if file_id is not None:
+        with _UPLOAD_HASHES_LOCK:
+            if file_id in _UPLOAD_HASHES:
+                return _UPLOAD_HASHES[file_id]
+
+    digest = content_hash(uploaded_file.getbuffer())
+    if file_id is not None:
+        with _UPLOAD_HASHES_LOCK:
+            _UPLOAD_HASHES[file_id] = digest
+            while len(_UPLOAD_HASHES) > _UPLOAD_HASHES_MAX:
+                _UPLOAD_HASHES.popitem(last=False)
+    return digest
+
+
+def session_cache(name: str, max_bytes: int) -> LRUCache:
+    """Per-session LRU cache stored in st.session_state, counted towards the process-wide ``SESSION_BUDGET``"""
+    key = f"_cache_{name}"
+    if key not in st.session_state:
+        st.session_state[key] = LRUCache(max_bytes, name, budget=SESSION_BUDGET)
+    return st.session_state[key]
@@ -0,0 +1,132 @@
+import io
+from functools import lru_cache
+
+import matplotlib
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
+
+from Pages.compact import dequantize_index
+
+
+# Płótno mapy: 20 x 14 cali przy 150 dpi (jak dotychczasowa figura)
+FIGURE_SIZE = (20, 14)
+FIGURE_DPI = 150
+CANVAS_SIZE = (FIGURE_SIZE[0] * FIGURE_DPI, FIGURE_SIZE[1] * FIGURE_DPI)
+
+LUT_SIZE = 256
+# Wpis LUT dla NaN (brak danych / maska): przezroczysty
+NAN_INDEX = LUT_SIZE
+
+BACKGROUND = (255, 255, 255, 255)
+
+
+@lru_cache(maxsize=64)
+def colormap_lut(colormap, reverse=False):
+    """(257, 4) uint8 RGBA lookup table of a matplotlib colormap; the extra last entry is for NaN"""
+    cmap = matplotlib.colormaps[colormap]
+    if reverse:
+        cmap = cmap.reversed()
+    lut = np.zeros((LUT_SIZE + 1, 4), dtype=np.uint8)
+    lut[:LUT_SIZE] = cmap(np.linspace(0.0, 1.0, LUT_SIZE), bytes=True)
+    lut.setflags(write=False)
+    return lut
+
+
+def block_mean(array, factor):
+    """Area-average downsample by an integer factor; NaN pixels are ignored (all-NaN cells stay NaN).
+
+    The factor x factor phases are accumulated as strided views, so every temporary
+    has the output size. Trailing rows/columns that do not fill a whole block are dropped.
+    Scaled int16 (compact) arrays are dequantized phase by phase.
+    """
+    if factor <= 1:
+        return dequantize_index(array)
+    out_h, out_w = array.shape[0] // factor, array.shape[1] // factor
+    total = np.zeros((out_h, out_w), dtype=np.float32)
+    count = np.zeros((out_h, out_w), dtype=np.float32)
+    scratch = np.empty((out_h, out_w), dtype=np.float32)
+    for i in range(factor):
+        for j in range(factor):
+            phase = dequantize_index(array[i:out_h * factor:factor, j:out_w * factor:factor])
+            # fmax(x, 0) + fmin(x, 0) == x, a dla NaN daje 0
+            np.fmax(phase, 0, out=scratch)
+            total += scratch
+            np.fmin(phase, 0, out=scratch)
+            total += scratch
+            count += phase == phase
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.divide(total, count, out=total)
+
+
+def colorize(array, lut, vmin=-1.0, vmax=1.0):
+    """Map values to RGBA through a lookup table; NaN gets the last LUT entry"""
+    index = np.subtract(array, vmin, dtype=np.float32)
+    index *= (LUT_SIZE - 1) / (vmax - vmin)
+    index += 0.5
+    np.clip(index, 0, LUT_SIZE - 1, out=index)
+    # fmin zamienia NaN na NAN_INDEX (fmin ignoruje NaN)
+    np.fmin(index, NAN_INDEX, out=index)
+    return np.take(lut, index.astype(np.uint16), axis=0)
+
+
+def render_raster(index_array, colormap, reverse=False, size=CANVAS_SIZE):
+    """RGBA image of an index stretched over the canvas (block mean, LUT colouring, bilinear resize)"""
+    width, height = size
+    h, w = index_array.shape
+    factor = max(1, min(h // height, w // width))
+    rgba = colorize(block_mean(index_array, factor), colormap_lut(colormap, reverse))
+    image = Image.fromarray(rgba, mode="RGBA")
+    if image.size != (width, height):
+        image = image.resize((width, height), Image.Resampling.BILINEAR)
+    return image
+
+
+def figure_layer(fig):
+    """Transparent RGBA image of a matplotlib Figure drawn with Agg (no pyplot state, nothing to close)"""
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    return Image.frombuffer("RGBA", canvas.get_width_height(), canvas.buffer_rgba(), "raw", "RGBA", 0, 1).copy()
+
+
+def decoration_layer(cache, name, draw, args=(), scale=1):
+    """Cached (RGBA array, (x, y) offset) of one decoration drawn by ``draw(fig, *args)``.
+
+    The layer is cropped to its visible pixels, so a legend box costs a few MB
+    instead of a full transparent canvas; the cache key is the layer's own parameters.
+    """
+    key = (name, scale) + tuple(args)
+    layer = cache.get(key)
+    if layer is None:
+        fig = Figure(figsize=FIGURE_SIZE, dpi=FIGURE_DPI * scale, facecolor="none")
+        draw(fig, *args)
+        image = figure_layer(fig)
+        bbox = image.getchannel("A").getbbox() or (0, 0, 1, 1)
+        layer = (np.asarray(image.crop(bbox)), bbox[:2])
+        cache.put(key, layer)
+    return layer
+
+
+def composite(layers, size=CANVAS_SIZE, background=BACKGROUND):
+    """Stack RGBA layers (bottom first; images or (RGBA array, (x, y) offset) pairs) over an opaque background"""
+    image = Image.new("RGBA", size, background)
+    for layer in layers:
+        if layer is None:
+            continue
+        if isinstance(layer, tuple):
+            array, offset = layer
+            image.alpha_composite(Image.fromarray(array, mode="RGBA"), dest=tuple(offset))
+        else:
+            image.alpha_composite(layer)
+    return image
+
+
+def encode_image(image, image_format="PNG"):
+    """Encoded bytes of an image: fast-zlib PNG for exports, JPEG (q=92) for the on-screen map"""
+    buf = io.BytesIO()
+    if image_format == "JPEG":
+        image.convert("RGB").save(buf, format="JPEG", quality=92)
+    else:
+        image.convert("RGB").save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
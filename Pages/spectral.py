@@ -0,0 +1,485 @@
+import weakref
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.enums import MaskFlags, Resampling
+from rasterio.windows import Window, bounds as window_bounds, from_bounds
+
+from Pages.compact import INDEX_DTYPE, cast_index, fill_nodata, quantize_index
+from Pages.masking import layer_valid
+from Pages.statistics import merge_partial_stats, partial_stats
+
+
+# Docelowa liczba pikseli w jednym bloku przy łączeniu pasków (striped GeoTIFF)
+BLOCK_PIXELS = 1024 * 1024
+
+EPS = 1e-10
+
+
+# Kernele indeksów: każdy liczy wynik w jednym przebiegu do bufora ``out``
+# (operacje in-place z ``out=``), używając co najwyżej jednego lub dwóch buforów roboczych.
+# Pasma mogą mieć dowolny typ (np. uint16) - obliczenia idą w typie ``out``.
+
+def _normalized_difference(a, b, out, eps=EPS, scale=1.0):
+    """scale * (a - b) / (a + b + eps)"""
+    scratch = np.add(a, b, dtype=out.dtype)
+    scratch += eps
+    np.subtract(a, b, out=out, dtype=out.dtype)
+    np.divide(out, scratch, out=out)
+    if scale != 1.0:
+        out *= scale
+    return out
+
+
+def _nd(first, second, **kwargs):
+    """Kernel for a normalized difference of the given band positions"""
+    return lambda *bands, out: _normalized_difference(bands[first], bands[second], out, **kwargs)
+
+
+def _evi(b, r, n, out):
+    """2.5 * (n - r) / (n + 6r - 7.5b + 1)"""
+    scratch = np.multiply(r, 6.0, dtype=out.dtype)
+    np.add(scratch, n, out=scratch)
+    np.multiply(b, 7.5, out=out, dtype=out.dtype)
+    scratch -= out
+    scratch += 1 + EPS
+    np.subtract(n, r, out=out, dtype=out.dtype)
+    np.divide(out, scratch, out=out)
+    out *= 2.5
+    return out
+
+
+def _bsi(b, r, n, s, out):
+    """((s + r) - (n + b)) / ((s + r) + (n + b))"""
+    np.add(s, r, out=out, dtype=out.dtype)
+    scratch = np.add(n, b, dtype=out.dtype)
+    out -= scratch
+    scratch *= 2
+    scratch += out
+    scratch += EPS
+    np.divide(out, scratch, out=out)
+    return out
+
+
+def _bais2(r, re2, re3, nir_n, swir2, out):
+    """(1 - sqrt(re2 * re3 * nir_n / r)) * ((swir2 - nir_n) / (sqrt(swir2 + nir_n) + 1) + 1)"""
+    np.multiply(re2, re3, out=out, dtype=out.dtype)
+    np.multiply(out, nir_n, out=out)
+    scratch = np.add(r, EPS, dtype=out.dtype)
+    np.divide(out, scratch, out=out)
+    np.sqrt(out, out=out)
+    np.subtract(1, out, out=out)
+
+    np.add(swir2, nir_n, out=scratch, dtype=out.dtype)
+    np.sqrt(scratch, out=scratch)
+    scratch += 1
+    numerator = np.subtract(swir2, nir_n, dtype=out.dtype)
+    np.divide(numerator, scratch, out=numerator)
+    numerator += 1
+    np.multiply(out, numerator, out=out)
+    return out
+
+
+INDEX_FORMULAS = {
+    "NDVI": {"bands": ["B4", "B8"], "kernel": _nd(1, 0)},
+    "EVI": {"bands": ["B2", "B4", "B8"], "kernel": _evi},
+    "SAVI": {"bands": ["B4", "B8"], "kernel": _nd(1, 0, eps=0.5, scale=1.5)},
+    "GNDVI": {"bands": ["B3", "B8"], "kernel": _nd(1, 0)},
+    "NDRE": {"bands": ["B5", "B8"], "kernel": _nd(1, 0)},
+
+    "NDWI": {"bands": ["B3", "B8"], "kernel": _nd(0, 1)},
+    "MNDWI": {"bands": ["B3", "B11"], "kernel": _nd(0, 1)},
+    "NDMI": {"bands": ["B8", "B11"], "kernel": _nd(0, 1)},
+
+    "NDBI": {"bands": ["B8", "B11"], "kernel": _nd(1, 0)},
+    "BSI": {"bands": ["B2", "B4", "B8", "B11"], "kernel": _bsi},
+    "UI": {"bands": ["B8", "B12"], "kernel": _nd(1, 0)},
+
+    "NBR": {"bands": ["B8", "B12"], "kernel": _nd(0, 1)},
+    "NBR2": {"bands": ["B11", "B12"], "kernel": _nd(0, 1)},
+    "BAIS2": {"bands": ["B4", "B6", "B7", "B8A", "B12"], "kernel": _bais2},
+
+    "NDSI": {"bands": ["B3", "B11"], "kernel": _nd(0, 1)},
+    "S2WI": {"bands": ["B8", "B12"], "kernel": _nd(0, 1)},
+}
+
+
+def compute_index(index_type, bands, out=None, dtype="float32"):
+    """Evaluate the kernel of ``index_type`` into ``out`` and clip it in place to [-1, 1]"""
+    if out is None:
+        out = np.empty(bands[0].shape, dtype=dtype)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        INDEX_FORMULAS[index_type]["kernel"](*bands, out=out)
+    np.clip(out, -1, 1, out=out)
+    return out
+
+
+def required_bands(index_types):
+    """Union of the bands needed by ``index_types``, in first-use order"""
+    bands = []
+    for index_type in index_types:
+        for b in INDEX_FORMULAS[index_type]["bands"]:
+            if b not in bands:
+                bands.append(b)
+    return bands
+
+
+def compute_indices(index_types, bands, out=None, dtype="float32"):
+    """Evaluate several indices on shared band arrays (dict band -> array) into an (n, h, w) stack"""
+    if out is None:
+        shape = next(iter(bands.values())).shape
+        out = np.empty((len(index_types),) + shape, dtype=dtype)
+    for i, index_type in enumerate(index_types):
+        arrays = [bands[b] for b in INDEX_FORMULAS[index_type]["bands"]]
+        compute_index(index_type, arrays, out=out[i], dtype=dtype)
+    return out
+
+
+def compute_indices_masked(index_types, bands, valid, out=None, dtype="float32", block_pixels=BLOCK_PIXELS,
+                           compact=False):
+    """``compute_indices`` with a validity mask (None = all valid); invalid pixels become NaN.
+
+    Row blocks without a single valid pixel are filled with NaN without being computed.
+    With ``compact`` each block is computed in ``dtype`` and stored as scaled int16.
+    """
+    if valid is None and not compact:
+        return compute_indices(index_types, bands, out=out, dtype=dtype)
+    height, width = next(iter(bands.values())).shape
+    if out is None:
+        out = np.empty((len(index_types), height, width), dtype=INDEX_DTYPE if compact else dtype)
+    rows = max(1, block_pixels // max(width, 1))
+    for r in range(0, height, rows):
+        block_valid = valid[r:r + rows] if valid is not None else None
+        target = out[:, r:r + rows]
+        if block_valid is not None and not block_valid.any():
+            fill_nodata(target)
+            continue
+        blocks = {b: band[r:r + rows] for b, band in bands.items()}
+        result = mask_invalid(
+            compute_indices(index_types, blocks, out=None if compact else target, dtype=dtype), block_valid,
+        )
+        if compact:
+            quantize_index(result, out=target)
+    return out
+
+
+GRID_FINEST = "finest"
+GRID_COARSEST = "coarsest"
+GRID_CUSTOM = "custom"
+
+# Siatka wyjściowa: transformacja + rozmiar; hashowalna, więc nadaje się na klucz cache
+Grid = namedtuple("Grid", ["transform", "width", "height"])
+
+
+def target_grid(profiles, mode=GRID_FINEST, resolution=None):
+    """Common output grid over the footprint of the first profile.
+
+    ``mode`` picks the finest or coarsest band resolution, or ``resolution``
+    (in CRS units) for GRID_CUSTOM.
+    """
+    ref = profiles[0]
+    t = ref["transform"]
+    left, top = t.c, t.f
+    right = left + t.a * ref["width"]
+    bottom = top + t.e * ref["height"]
+
+    resolutions = [abs(p["transform"].a) for p in profiles]
+    if mode == GRID_COARSEST:
+        res = max(resolutions)
+    elif mode == GRID_CUSTOM and resolution:
+        res = float(resolution)
+    else:
+        res = min(resolutions)
+
+    width = max(1, int(round((right - left) / res)))
+    height = max(1, int(round((top - bottom) / res)))
+    return Grid(Affine(res, 0.0, left, 0.0, -res, top), width, height)
+
+
+def grid_profile(profile, grid):
+    """Copy of a band profile moved onto ``grid``"""
+    profile = profile.copy()
+    profile.update(transform=grid.transform, width=grid.width, height=grid.height)
+    return profile
+
+
+def preview_grid(grid, max_width=3000, max_height=2100):
+    """Grid decimated by an integer factor to fit the display canvas.
+
+    Decimated reads are served from internal overviews by GDAL when the file has them.
+    """
+    factor = max(1, int(np.ceil(max(grid.width / max_width, grid.height / max_height))))
+    if factor == 1:
+        return grid
+    return Grid(
+        grid.transform * Affine.scale(factor),
+        max(1, grid.width // factor),
+        max(1, grid.height // factor),
+    )
+
+
+def on_grid(src, grid):
+    return grid is None or (
+        src.transform == grid.transform and (src.width, src.height) == (grid.width, grid.height)
+    )
+
+
+def _grid_window(src, grid, window):
+    """Source window covering ``window`` of ``grid`` (float offsets, no snapping) and the output shape"""
+    if window is None:
+        window = Window(0, 0, grid.width, grid.height)
+    src_window = from_bounds(*window_bounds(window, grid.transform), transform=src.transform)
+    return src_window, (int(window.height), int(window.width))
+
+
+def read_on_grid(src, grid=None, window=None, resampling="bilinear"):
+    """Read band 1 resampled onto ``grid`` during the read (out_shape), optionally one window of it.
+
+    No full-resolution intermediate is materialised: a coarser grid makes GDAL
+    read decimated (or from overviews), a finer one interpolates on the fly.
+    """
+    if on_grid(src, grid):
+        return src.read(1, window=window)
+    src_window, shape = _grid_window(src, grid, window)
+    return src.read(1, window=src_window, out_shape=shape, resampling=Resampling[resampling])
+
+
+def has_mask(src):
+    """Whether band 1 has a nodata value or a mask band (otherwise every pixel is valid)"""
+    return MaskFlags.all_valid not in src.mask_flag_enums[0]
+
+
+def read_valid_on_grid(src, grid=None, window=None):
+    """Validity of band 1 on ``grid`` (True = valid pixel), or None when the band has no nodata/mask"""
+    if not has_mask(src):
+        return None
+    if on_grid(src, grid):
+        return src.read_masks(1, window=window) > 0
+    src_window, shape = _grid_window(src, grid, window)
+    return src.read_masks(1, window=src_window, out_shape=shape, resampling=Resampling.nearest) > 0
+
+
+def read_mask_layer(src, rule, grid, window=None):
+    """Validity of a cloud-mask layer (SCL / B10 / QA60) on ``grid``; classes are never interpolated"""
+    return layer_valid(rule, read_on_grid(src, grid, window=window, resampling="nearest"))
+
+
+def read_bands(datasets, grid, window=None, resampling="bilinear", executor=None, masks=None):
+    """Band blocks of one window and their combined validity (None = every pixel valid).
+
+    Cloud-mask layers (``masks``: name -> (dataset, rule)) and band masks are read
+    first; when the window turns out fully masked the bands are not read at all
+    and None is returned in place of the blocks.
+    """
+    valid = None
+    for src, rule in (masks or {}).values():
+        layer = read_mask_layer(src, rule, grid, window)
+        valid = layer if valid is None else np.logical_and(valid, layer, out=valid)
+        if not valid.any():
+            return None, valid
+    for src in datasets.values():
+        band_valid = read_valid_on_grid(src, grid, window)
+        if band_valid is None:
+            continue
+        valid = band_valid if valid is None else np.logical_and(valid, band_valid, out=valid)
+        if not valid.any():
+            return None, valid
+
+    def read(src):
+        return read_on_grid(src, grid, window=window, resampling=resampling)
+
+    if executor is None:
+        blocks = {b: read(src) for b, src in datasets.items()}
+    else:
+        blocks = dict(zip(datasets.keys(), executor.map(read, datasets.values())))
+    return blocks, valid
+
+
+def combine_valid(masks):
+    """Logical AND of validity masks, skipping None (= all valid); None when no mask is given"""
+    valid = None
+    for mask in masks:
+        if mask is not None:
+            valid = mask.copy() if valid is None else np.logical_and(valid, mask, out=valid)
+    return valid
+
+
+def mask_invalid(result, valid):
+    """Set invalid pixels of an index block (or (n, h, w) stack) to NaN in place"""
+    if valid is not None:
+        np.copyto(result, np.nan, where=~valid)
+    return result
+
+
+def iter_blocks(src, block_pixels=BLOCK_PIXELS):
+    """Native block windows of band 1; thin full-width strips are merged up to block_pixels"""
+    block_h, block_w = src.block_shapes[0]
+    if block_w < src.width:
+        for _, window in src.block_windows(1):
+            yield window
+        return
+
+    rows = max(block_h, (block_pixels // max(src.width, 1)) // block_h * block_h)
+    for row_off in range(0, src.height, rows):
+        yield Window(0, row_off, src.width, min(rows, src.height - row_off))
+
+
+def iter_grid_blocks(datasets, grid):
+    """Block windows over the output grid: native blocks of a band already on it, else square tiles"""
+    for src in datasets:
+        if on_grid(src, grid):
+            yield from iter_blocks(src)
+            return
+    yield from iter_tiles(grid.height, grid.width, tile_size=int(BLOCK_PIXELS ** 0.5))
+
+
+def stream_indices(datasets, index_types, out=None, dst=None, dtype="float32", executor=None,
+                   grid=None, resampling="bilinear", masks=None, windows=None, compact=False):
+    """Evaluate indices block by block, so peak memory is bounded by the block size.
+
+    ``datasets`` maps band names to open rasterio datasets; every band is read once
+    per block and shared by all ``index_types``. Results go into ``out``
+    (a preallocated (n, h, w) stack, allocated when both targets are None) and/or
+    are written to the open n-band rasterio dataset ``dst`` window by window.
+    With an ``executor`` the band blocks of each window are read concurrently.
+    Bands are resampled onto ``grid`` while they are read (default: grid of the first band).
+    Pixels masked in any band (nodata or mask band) or by a cloud-mask layer in
+    ``masks`` (name -> (dataset, rule)) become NaN; fully masked blocks are neither
+    read nor computed. ``windows`` overrides the block windows (e.g. the tiles of ``dst``).
+    With ``compact`` the allocated ``out`` holds scaled int16 values (see Pages.compact).
+    """
+    ref = next(iter(datasets.values()))
+    if grid is None:
+        grid = Grid(ref.transform, ref.width, ref.height)
+
+    if out is None and dst is None:
+        out = np.empty((len(index_types), grid.height, grid.width), dtype=INDEX_DTYPE if compact else dtype)
+
+    if windows is None:
+        windows = iter_grid_blocks(datasets.values(), grid)
+    for window in windows:
+        blocks, valid = read_bands(datasets, grid, window, resampling, executor, masks)
+        target = out[(slice(None),) + window.toslices()] if out is not None else None
+        # Wynik int16 jest kwantyzowany z bloku liczonego w ``dtype``
+        buffer = target if target is not None and target.dtype == dtype else None
+        if blocks is None:
+            # Blok w całości bez danych - nic nie liczymy
+            if buffer is None:
+                buffer = np.empty((len(index_types), int(window.height), int(window.width)), dtype=dtype)
+            result = fill_nodata(buffer)
+        else:
+            result = mask_invalid(compute_indices(index_types, blocks, out=buffer, dtype=dtype), valid)
+        if target is not None and result is not target:
+            target[...] = cast_index(result, target.dtype)
+        if dst is not None:
+            dst.write(cast_index(result, dst.dtypes[0]), window=window)
+    return out
+
+
+# Kafle przetwarzane w puli procesów (wyrównane do bloków GeoTIFF)
+TILE_SIZE = 2048
+
+_process_pool = None
+_process_pool_workers = 0
+
+
+def process_pool(workers):
+    """Shared spawn-based process pool, recreated when the worker count changes or a worker died"""
+    global _process_pool, _process_pool_workers
+    # Pula po BrokenProcessPool (np. proces zabity przez OOM) nie przyjmuje już zadań
+    broken = _process_pool is not None and getattr(_process_pool, "_broken", False)
+    if _process_pool is None or broken or _process_pool_workers != workers:
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"))
+        _process_pool_workers = workers
+    return _process_pool
+
+
+def iter_tiles(height, width, tile_size=TILE_SIZE):
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            yield Window(col_off, row_off, min(tile_size, width - col_off), min(tile_size, height - row_off))
+
+
+def _tile_worker(paths, index_types, dtype, shm_name, shape, window, grid, resampling, masks):
+    """Compute one tile straight into the shared output; returns partial stats per index"""
+    shm = SharedMemory(name=shm_name)
+    out = target = None
+    try:
+        out = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        with ExitStack() as stack:
+            datasets = {b: stack.enter_context(rasterio.open(p)) for b, p in paths.items()}
+            layers = {b: (stack.enter_context(rasterio.open(p)), rule) for b, (p, rule) in masks.items()}
+            blocks, valid = read_bands(datasets, grid, window, resampling, masks=layers)
+        target = out[(slice(None),) + window.toslices()]
+        if blocks is None:
+            target.fill(np.nan)
+        else:
+            mask_invalid(compute_indices(index_types, blocks, out=target, dtype=dtype), valid)
+        return [partial_stats(target[i]) for i in range(len(index_types))]
+    finally:
+        del out, target
+        shm.close()
+
+
+def compute_indices_tiled(paths, index_types, workers, dtype="float32", tile_size=TILE_SIZE,
+                          grid=None, resampling="bilinear", masks=None, compact=False):
+    """Split the scene into tiles and compute them in a process pool.
+
+    ``paths`` maps band names to GeoTIFF paths which every worker opens itself;
+    tiles are written into one shared-memory (n, h, w) stack, so no arrays are
+    pickled. The returned stack is a view of that segment (unlinked at once, unmapped
+    when the array is freed), so the result is never copied. Bands are resampled
+    onto ``grid`` while they are read; cloud-mask layers are given as ``masks``
+    (name -> (path, rule)). With ``compact`` the shared stack is quantized into
+    scaled int16. A pool broken by a dead worker is rebuilt and the tiles are
+    computed once more. Returns the stack and merged statistics per index.
+    """
+    if grid is None:
+        with rasterio.open(next(iter(paths.values()))) as ref:
+            grid = Grid(ref.transform, ref.width, ref.height)
+    height, width = grid.height, grid.width
+    shape = (len(index_types), height, width)
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+    shm = SharedMemory(create=True, size=max(nbytes, 1))
+    try:
+        for attempt in range(2):
+            pool = process_pool(workers)
+            try:
+                futures = [
+                    pool.submit(_tile_worker, paths, index_types, dtype, shm.name, shape, window, grid,
+                                resampling, masks or {})
+                    for window in iter_tiles(height, width, tile_size)
+                ]
+                tile_stats = [f.result() for f in futures]
+                break
+            except BrokenProcessPool:
+                if attempt:
+                    raise
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+
+    # Nazwa segmentu znika od razu; pamięć zostaje zmapowana tak długo, jak żyje wynik
+    shm.unlink()
+    shared = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    if compact:
+        result = quantize_index(shared)
+        del shared
+        shm.close()
+    else:
+        result = shared
+        weakref.finalize(result, shm.close)
+
+    stats = [merge_partial_stats(s[i] for s in tile_stats) for i in range(len(index_types))]
+    return result, stats
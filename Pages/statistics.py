@@ -0,0 +1,272 @@
+import time
+
+import numpy as np
+
+from Pages.compact import dequantize_index
+
+
+# Indeksy są przycinane do [-1, 1]; 4096 koszyków daje błąd mediany/percentyli < 0.0005
+HIST_BINS = 4096
+HIST_RANGE = (-1.0, 1.0)
+
+STATS_BLOCK_PIXELS = 1024 * 1024
+
+PERCENTILES = (10, 25, 75, 90)
+
+
+def _empty_stats(bins=HIST_BINS):
+    return {"count": 0, "pixels": 0, "mean": 0.0, "m2": 0.0, "min": np.inf, "max": -np.inf,
+            "histogram": np.zeros(bins, dtype=np.int64)}
+
+
+def partial_stats(array, bins=HIST_BINS, value_range=HIST_RANGE):
+    """Mergeable moments (count, mean, M2, min, max) and a fixed-bin histogram of the non-NaN values of a block.
+
+    NaN pixels are neutralised with fmin/fmax (which ignore NaN) instead of being
+    compacted with a boolean mask, so the block is never copied value by value.
+    """
+    part = _empty_stats(bins)
+    array = dequantize_index(array)
+    part["pixels"] = int(array.size)
+    lo, hi = value_range
+
+    # Numer koszyka; NaN przechodzi przez clip i fmin zamienia go na koszyk nadmiarowy ``bins``
+    index = np.subtract(array, lo, dtype=np.float64)
+    np.multiply(index, bins / (hi - lo), out=index)
+    np.clip(index, 0, bins - 1, out=index)
+    np.fmin(index, bins, out=index)
+    histogram = np.bincount(index.astype(np.intp).ravel(), minlength=bins + 1)
+    count = int(array.size - histogram[bins])
+    if count == 0:
+        return part
+
+    # Suma bez NaN: fmax(x, 0) + fmin(x, 0) == x, a dla NaN daje 0
+    scratch = index
+    np.fmax(array, 0, out=scratch)
+    total = float(np.add.reduce(scratch, axis=None))
+    np.fmin(array, 0, out=scratch)
+    total += float(np.add.reduce(scratch, axis=None))
+    mean = total / count
+
+    np.subtract(array, mean, out=scratch)
+    np.square(scratch, out=scratch)
+    np.fmax(scratch, 0, out=scratch)
+
+    part.update(
+        count=count,
+        mean=mean,
+        m2=float(np.add.reduce(scratch, axis=None)),
+        min=float(np.fmin.reduce(array, axis=None)),
+        max=float(np.fmax.reduce(array, axis=None)),
+        histogram=histogram[:bins],
+    )
+    return part
+
+
+def merge_partial_stats(parts):
+    """Combine partial moments with the parallel variance formula (Chan et al.); histograms are summed"""
+    total = None
+    for part in parts:
+        if total is None:
+            total = _empty_stats(len(part["histogram"]))
+        total["histogram"] += part["histogram"]
+        total["pixels"] += part["pixels"]
+        if part["count"] == 0:
+            continue
+        n_a, n_b = total["count"], part["count"]
+        n = n_a + n_b
+        delta = part["mean"] - total["mean"]
+        total["mean"] += delta * n_b / n
+        total["m2"] += part["m2"] + delta * delta * n_a * n_b / n
+        total["count"] = n
+        total["min"] = min(total["min"], part["min"])
+        total["max"] = max(total["max"], part["max"])
+    return total if total is not None else _empty_stats()
+
+
+def array_stats(array, block_pixels=STATS_BLOCK_PIXELS, bins=HIST_BINS, value_range=HIST_RANGE):
+    """Partial statistics of a whole array, accumulated over row blocks in a single pass"""
+    array = np.asarray(array)
+    if array.ndim < 2:
+        array = array.reshape(1, -1)
+    row_pixels = max(1, array[0].size)
+    rows = max(1, block_pixels // row_pixels)
+    return merge_partial_stats(
+        partial_stats(array[r:r + rows], bins, value_range) for r in range(0, array.shape[0], rows)
+    )
+
+
+def histogram_percentile(histogram, q, count, vmin, vmax, value_range=HIST_RANGE):
+    """Percentile ``q`` (0-100) interpolated inside its histogram bin; error is at most one bin width"""
+    lo, hi = value_range
+    width = (hi - lo) / len(histogram)
+    rank = q / 100.0 * (count - 1)
+    cdf = np.cumsum(histogram)
+    i = int(np.searchsorted(cdf, rank, side="right"))
+    i = min(i, len(histogram) - 1)
+    before = cdf[i] - histogram[i]
+    frac = (rank - before + 0.5) / histogram[i] if histogram[i] else 0.5
+    return float(np.clip(lo + (i + frac) * width, vmin, vmax))
+
+
+def summarize_stats(total, percentiles=PERCENTILES, value_range=HIST_RANGE):
+    """Final statistics (mean, median, std, min, max, count, masked %, percentiles) from merged partial statistics"""
+    count = total["count"]
+    pixels = total["pixels"]
+    masked = 100.0 * (1.0 - count / pixels) if pixels else 0.0
+    if count == 0:
+        nan = float("nan")
+        stats = {"mean": nan, "median": nan, "std": nan, "min": nan, "max": nan, "count": 0,
+                 "masked_pct": masked}
+        stats.update({f"p{q}": nan for q in percentiles})
+        return stats
+
+    histogram = total["histogram"]
+
+    def percentile(q):
+        return histogram_percentile(histogram, q, count, total["min"], total["max"], value_range)
+
+    stats = {
+        "mean": float(total["mean"]),
+        "median": percentile(50),
+        "std": float(np.sqrt(total["m2"] / count)),
+        "min": float(total["min"]),
+        "max": float(total["max"]),
+        "count": int(count),
+        "masked_pct": masked,
+    }
+    stats.update({f"p{q}": percentile(q) for q in percentiles})
+    stats["histogram"] = histogram
+    return stats
+
+
+# Próbka warstwowa: siatka STRATA x STRATA komórek, w każdej losowe piksele
+SAMPLE_STRATA = 16
+SAMPLE_PER_STRATUM = 256
+Z95 = 1.959964
+
+
+def _estimate(stats, scanned, mean_ci, median_ci):
+    stats.update(exact=False, scanned=scanned, mean_ci=mean_ci, median_ci=median_ci)
+    return stats
+
+
+def sample_stats(array, strata=SAMPLE_STRATA, per_stratum=SAMPLE_PER_STRATUM, seed=0):
+    """Estimated statistics from a stratified random pixel sample, with 95% confidence intervals.
+
+    Strata are cells of a regular grid over the raster; each contributes with a weight
+    equal to its estimated number of valid pixels. Min and max are sample extremes.
+    """
+    array = np.asarray(array)
+    h, w = array.shape[-2:]
+    rng = np.random.default_rng(seed)
+    row_edges = np.linspace(0, h, min(strata, h) + 1).astype(int)
+    col_edges = np.linspace(0, w, min(strata, w) + 1).astype(int)
+
+    values, weights, means, variances, sizes = [], [], [], [], []
+    for r0, r1 in zip(row_edges[:-1], row_edges[1:]):
+        for c0, c1 in zip(col_edges[:-1], col_edges[1:]):
+            rows = rng.integers(r0, r1, per_stratum)
+            cols = rng.integers(c0, c1, per_stratum)
+            v = dequantize_index(array[rows, cols]).astype(np.float64)
+            v = v[~np.isnan(v)]
+            if v.size == 0:
+                continue
+            weight = (r1 - r0) * (c1 - c0) * v.size / per_stratum
+            values.append(v)
+            weights.append(np.full(v.size, weight / v.size))
+            means.append(v.mean())
+            variances.append(v.var(ddof=1) if v.size > 1 else 0.0)
+            sizes.append((weight, v.size))
+
+    if not values:
+        empty = _empty_stats()
+        empty["pixels"] = h * w
+        return _estimate(summarize_stats(empty), 0.0, float("nan"), (float("nan"), float("nan")))
+
+    w_h = np.array([s[0] for s in sizes])
+    n_h = np.array([s[1] for s in sizes])
+    valid_pixels = w_h.sum()
+    w_h = w_h / valid_pixels
+    means = np.array(means)
+    variances = np.array(variances)
+    mean = float(np.sum(w_h * means))
+    mean_se = float(np.sqrt(np.sum(w_h ** 2 * variances / n_h)))
+    variance = float(np.sum(w_h * (variances + (means - mean) ** 2)))
+
+    values = np.concatenate(values)
+    weights = np.concatenate(weights)
+    order = np.argsort(values)
+    values, cdf = values[order], np.cumsum(weights[order])
+    cdf /= cdf[-1]
+    n = values.size
+
+    def quantile(q):
+        return float(values[min(int(np.searchsorted(cdf, q)), n - 1)])
+
+    half = Z95 * np.sqrt(0.25 / n)
+    stats = {
+        "mean": mean,
+        "median": quantile(0.5),
+        "std": float(np.sqrt(variance)),
+        "min": float(values[0]),
+        "max": float(values[-1]),
+        "count": int(round(valid_pixels)),
+        "masked_pct": 100.0 * (1.0 - valid_pixels / (h * w)),
+    }
+    stats.update({f"p{q}": quantile(q / 100.0) for q in PERCENTILES})
+    return _estimate(stats, n / (h * w), Z95 * mean_se,
+                     (quantile(max(0.0, 0.5 - half)), quantile(min(1.0, 0.5 + half))))
+
+
+def progressive_array_stats(array, progress, block_pixels=STATS_BLOCK_PIXELS, interval=0.25, seed=0,
+                            bins=HIST_BINS, value_range=HIST_RANGE):
+    """Same result as ``array_stats``, but refined estimates are passed to ``progress`` while it runs.
+
+    The first estimate comes from ``sample_stats``; then row blocks are scanned in
+    random order, so the blocks seen so far are a cluster sample of the raster and
+    their merged statistics are reported (at most every ``interval`` seconds) with
+    confidence intervals that shrink to zero as the scan completes. Scan estimates
+    start from two blocks (the first one gives no variance); until then the sample
+    estimate stands.
+    """
+    array = np.asarray(array)
+    progress(sample_stats(array, seed=seed))
+
+    rows = max(1, block_pixels // max(1, array[0].size))
+    starts = np.random.default_rng(seed).permutation(np.arange(0, array.shape[0], rows))
+    parts = []
+    reported = time.perf_counter()
+    for i, r in enumerate(starts, start=1):
+        parts.append(partial_stats(array[r:r + rows], bins, value_range))
+        if 2 <= i < len(starts) and time.perf_counter() - reported >= interval:
+            progress(_scan_estimate(parts, len(starts), value_range))
+            reported = time.perf_counter()
+    return merge_partial_stats(parts)
+
+
+def _scan_estimate(parts, n_blocks, value_range):
+    """Estimate from the first scanned blocks (ratio estimator over a cluster sample without replacement)"""
+    total = merge_partial_stats(parts)
+    stats = summarize_stats(total, value_range=value_range)
+    m, count = len(parts), total["count"]
+    stats["count"] = int(round(count * n_blocks / m))
+    if count == 0 or m < 2:
+        return _estimate(stats, m / n_blocks, float("nan"), (float("nan"), float("nan")))
+
+    counts = np.array([p["count"] for p in parts], dtype=np.float64)
+    sums = np.array([p["mean"] * p["count"] for p in parts])
+    residuals = sums - total["mean"] * counts
+    fpc = 1.0 - m / n_blocks
+    mean_se = np.sqrt(fpc * np.var(residuals, ddof=1) / m) / counts.mean()
+
+    # Przedział mediany z rozkładu dwumianowego rang, poszerzony o efekt klastrowania (deff)
+    srs_se = np.sqrt(total["m2"] / count / count) if total["m2"] > 0 else 0.0
+    deff = (mean_se / srs_se) ** 2 if srs_se > 0 else 1.0
+    half = Z95 * np.sqrt(0.25 * max(deff, 1.0) * fpc / count) * 100.0
+    histogram = total["histogram"]
+    bounds = tuple(
+        histogram_percentile(histogram, q, count, total["min"], total["max"], value_range)
+        for q in (max(0.0, 50.0 - half), min(100.0, 50.0 + half))
+    )
+    return _estimate(stats, m / n_blocks, float(Z95 * mean_se), bounds)
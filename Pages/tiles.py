@@ -0,0 +1,347 @@
+import io
+import logging
+import math
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import matplotlib
+import numpy as np
+import shapely
+from affine import Affine
+from PIL import Image
+from rasterio.transform import array_bounds, from_bounds
+from rasterio.warp import Resampling, reproject, transform_bounds
+from rasterio.windows import Window, from_bounds as window_from_bounds
+
+from Pages.compact import INDEX_NODATA, dequantize_index, is_compact
+from Pages.raster_cache import TILE_CACHE_BYTES, TILE_SOURCE_BYTES, LRUCache
+from Pages.render import block_mean, colorize, colormap_lut
+from Pages.vectors import OVERLAY_ZOOMS, mercator_geometries, overlay_level
+
+
+TILE_SIZE = 256
+WEB_MERCATOR = "EPSG:3857"
+# Połowa obwodu Ziemi w Web Mercator (m)
+MERCATOR_EXTENT = 20037508.342789244
+
+# Serwer kafli: adres nasłuchu (domyślnie tylko lokalnie; kontener ustawia 0.0.0.0), stały port
+# (przeglądarka łączy się z hostem strony na tym porcie) i opcjonalny publiczny adres (reverse proxy / HTTPS)
+TILE_HOST = os.environ.get("INVISTERRA_TILE_HOST", "127.0.0.1")
+TILE_PORT = int(os.environ.get("INVISTERRA_TILE_PORT", "8502"))
+TILE_PUBLIC_URL = os.environ.get("INVISTERRA_TILE_URL", "")
+
+logger = logging.getLogger(__name__)
+
+# Przybliżony koszt pamięci jednego wierzchołka warstwy wektorowej przygotowanej dla mapy
+_OVERLAY_BYTES_PER_COORD = 64
+
+# Zapas pikseli wokół okna źródłowego (interpolacja dwuliniowa na krawędziach kafla)
+_WINDOW_PAD = 2
+
+_TILE_PATH = re.compile(r"^/tiles/(?P<source>[0-9a-f]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$")
+_OVERLAY_PATH = re.compile(r"^/overlays/(?P<overlay>[0-9a-f]+)/(?P<z>\d+)\.json$")
+
+
+def _encode_png(rgba):
+    buf = io.BytesIO()
+    Image.fromarray(rgba, mode="RGBA").save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+
+EMPTY_TILE = _encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+
+
+def tile_bounds(z, x, y):
+    """Web Mercator bounds (left, bottom, right, top) of an XYZ tile"""
+    size = 2 * MERCATOR_EXTENT / (1 << z)
+    left = -MERCATOR_EXTENT + x * size
+    top = MERCATOR_EXTENT - y * size
+    return left, top - size, left + size, top
+
+
+class TileSource:
+    """Index array on its grid plus lazily built 2x block-mean overviews for low zoom levels"""
+
+    def __init__(self, array, profile):
+        self.array = array
+        self.crs = profile["crs"]
+        self.transform = profile["transform"]
+        self.bounds = transform_bounds(
+            self.crs, WEB_MERCATOR, *array_bounds(array.shape[0], array.shape[1], self.transform), densify_pts=21,
+        )
+        # Rozmiar piksela źródła w metrach Web Mercator (przybliżony, do wyboru poziomu)
+        self.resolution = (self.bounds[2] - self.bounds[0]) / array.shape[1]
+        self._overviews = {0: array}
+        self._lock = threading.Lock()
+
+    def overview(self, level):
+        """(array, transform) downsampled by 2**level; float32 from level 1 on"""
+        with self._lock:
+            # Piramida: każdy poziom to średnia 2x2 poprzedniego
+            for k in range(1, level + 1):
+                if k not in self._overviews:
+                    self._overviews[k] = block_mean(self._overviews[k - 1], 2)
+        return self._overviews[level], self.transform * Affine.scale(1 << level)
+
+    def level_for(self, z):
+        """Coarsest overview still at least as fine as the tile pixels of zoom ``z``"""
+        pixel = 2 * MERCATOR_EXTENT / (1 << z) / TILE_SIZE
+        # Najmniejszy poziom ma jeszcze co najmniej jeden kafel pikseli
+        max_level = max(int(math.log2(max(min(self.array.shape) / TILE_SIZE, 1.0))), 0)
+        return int(np.clip(math.floor(math.log2(max(pixel / self.resolution, 1.0))), 0, max_level))
+
+    def intersects(self, bounds):
+        return not (bounds[0] >= self.bounds[2] or bounds[2] <= self.bounds[0]
+                    or bounds[1] >= self.bounds[3] or bounds[3] <= self.bounds[1])
+
+
+def render_tile(source, z, x, y, colormap, reverse=False):
+    """PNG bytes of one Web Mercator tile of ``source`` (bilinear reprojection of the source window only)"""
+    bounds = tile_bounds(z, x, y)
+    if not source.intersects(bounds):
+        return EMPTY_TILE
+
+    array, transform = source.overview(source.level_for(z))
+    # Tylko okno źródła pod kaflem jest kopiowane do GDAL, nie cały raster
+    window = window_from_bounds(*transform_bounds(WEB_MERCATOR, source.crs, *bounds, densify_pts=21),
+                                transform=transform)
+    row0 = max(int(math.floor(window.row_off)) - _WINDOW_PAD, 0)
+    col0 = max(int(math.floor(window.col_off)) - _WINDOW_PAD, 0)
+    row1 = min(int(math.ceil(window.row_off + window.height)) + _WINDOW_PAD, array.shape[0])
+    col1 = min(int(math.ceil(window.col_off + window.width)) + _WINDOW_PAD, array.shape[1])
+    if row1 <= row0 or col1 <= col0:
+        return EMPTY_TILE
+    block = Window(col0, row0, col1 - col0, row1 - row0)
+
+    # Wynik kompaktowy jest reprojektowany jako int16 i dopiero potem skalowany
+    nodata = INDEX_NODATA if is_compact(array) else np.nan
+    tile = np.full((TILE_SIZE, TILE_SIZE), nodata, dtype=array.dtype)
+    reproject(
+        np.ascontiguousarray(array[block.toslices()]),
+        tile,
+        src_transform=transform * Affine.translation(col0, row0),
+        src_crs=source.crs,
+        src_nodata=nodata,
+        dst_transform=from_bounds(*bounds, TILE_SIZE, TILE_SIZE),
+        dst_crs=WEB_MERCATOR,
+        dst_nodata=nodata,
+        resampling=Resampling.bilinear,
+    )
+    return _encode_png(colorize(dequantize_index(tile), colormap_lut(colormap, reverse)))
+
+
+class FeatureSource:
+    """Vector layer prepared for the web map: per-zoom simplified levels, built once in a background thread"""
+
+    def __init__(self, geometries, zooms=OVERLAY_ZOOMS):
+        self.zooms = tuple(sorted(zooms))
+        # Szacunek pamięci dla LRU: geometrie Web Mercator i tekst GeoJSON wszystkich poziomów
+        self.nbytes = int(shapely.get_num_coordinates(np.asarray(geometries.values, dtype=object)).sum()) \
+            * _OVERLAY_BYTES_PER_COORD
+        self._geometries = geometries
+        self._mercator = None
+        self._levels = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._build, name="overlay-levels", daemon=True).start()
+
+    def _build(self):
+        for zoom in self.zooms:
+            self.level(zoom)
+
+    def level(self, zoom):
+        """``OverlayLevel`` of the nearest prepared zoom not above ``zoom``"""
+        zoom = max([z for z in self.zooms if z <= zoom] or self.zooms[:1])
+        with self._lock:
+            if self._mercator is None:
+                self._mercator = mercator_geometries(self._geometries)
+                self._geometries = None
+            if zoom not in self._levels:
+                self._levels[zoom] = overlay_level(*self._mercator, zoom)
+            return self._levels[zoom]
+
+
+def _hex_colors(values, colormap, reverse=False):
+    """'#rrggbb' strings of values through the colormap LUT (None for NaN)"""
+    rgba = colorize(np.asarray(values, dtype=np.float32), colormap_lut(colormap, reverse))
+    return [f"#{r:02x}{g:02x}{b:02x}" if a else None for r, g, b, a in rgba.tolist()]
+
+
+def feature_properties(values, colormap, reverse=False):
+    """Pre-encoded GeoJSON ``properties`` of every feature: value and fill colour"""
+    colors = _hex_colors(values, colormap, reverse)
+    return np.array([
+        '{"v":null,"c":null}' if c is None else f'{{"v":{v:.4f},"c":"{c}"}}'
+        for v, c in zip(np.asarray(values, dtype=np.float64).tolist(), colors)
+    ], dtype=object)
+
+
+def overlay_json(level, properties, bbox=None):
+    """FeatureCollection bytes of one overlay level, limited to the features meeting ``bbox`` (lon/lat)"""
+    hits = np.arange(len(level.features))
+    if bbox is not None:
+        west, south, east, north = bbox
+        b = level.bounds
+        hits = np.flatnonzero((b[:, 0] <= east) & (b[:, 2] >= west) & (b[:, 1] <= north) & (b[:, 3] >= south))
+    features = ",".join(
+        f'{{"type":"Feature","id":{i},"properties":{p},"geometry":{g}}}'
+        for i, p, g in zip(level.features[hits].tolist(), properties[level.features[hits]], level.geojson[hits])
+    )
+    return f'{{"type":"FeatureCollection","features":[{features}]}}'.encode("utf-8")
+
+
+class TileServer:
+    """In-process map endpoint shared by all sessions; requests run in daemon threads.
+
+    ``/tiles/<source>/{z}/{x}/{y}.png?cmap=<colormap>&reverse=<0|1>`` serves index
+    tiles, ``/overlays/<overlay>/{z}.json?bbox=<w,s,e,n>`` the simplified zonal
+    choropleth of one zoom level. Sources, layers and rendered tiles live in
+    process-wide memory-bounded LRU caches.
+
+    URLs are returned as paths; the browser prefixes them with ``public_url`` or,
+    without it, with the host it loaded the app from and ``port``.
+    """
+
+    def __init__(self, host=TILE_HOST, port=TILE_PORT, public_url=TILE_PUBLIC_URL):
+        self.sources = LRUCache(TILE_SOURCE_BYTES)
+        self.tiles = LRUCache(TILE_CACHE_BYTES)
+        self.layers = LRUCache(TILE_SOURCE_BYTES)
+        self.overlays = LRUCache(TILE_CACHE_BYTES)
+        try:
+            self.httpd = ThreadingHTTPServer((host, port), _tile_handler(self))
+        except OSError as e:
+            # Port zajęty (np. druga instancja aplikacji) - wolny port, działa tylko bez mapowania portów
+            logger.warning("Tile server cannot bind %s:%s (%s); using a free port", host, port, e)
+            self.httpd = ThreadingHTTPServer((host, 0), _tile_handler(self))
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.public_url = public_url.rstrip("/")
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="tile-server", daemon=True)
+        self.thread.start()
+
+    def register(self, key, array, profile):
+        """Serve ``array`` (on the grid of ``profile``) as source ``key``; returns its URL path template"""
+        if self.sources.get(key) is None:
+            self.sources.put(key, (array, TileSource(array, profile)))
+        return f"/tiles/{key}/{{z}}/{{x}}/{{y}}.png"
+
+    def tile(self, key, z, x, y, colormap, reverse=False):
+        """PNG bytes of a tile (rendered on demand, then cached), or None for an unknown source"""
+        cache_key = (key, z, x, y, colormap, reverse)
+        data = self.tiles.get(cache_key)
+        if data is None:
+            entry = self.sources.get(key)
+            if entry is None:
+                return None
+            data = render_tile(entry[1], z, x, y, colormap, reverse)
+            self.tiles.put(cache_key, data)
+        return data
+
+    def register_overlay(self, layer_key, geometries, key, values, colormap, reverse=False):
+        """Serve ``values`` over the features of layer ``layer_key`` as overlay ``key``; returns its URL path template.
+
+        The simplified levels belong to the layer, so every index, colormap and
+        statistic shown over one vector upload reuses them.
+        """
+        layer = self.layers.get(layer_key)
+        if layer is None:
+            layer = FeatureSource(geometries)
+            self.layers.put(layer_key, layer)
+        if self.overlays.get(key) is None:
+            self.overlays.put(key, (layer, feature_properties(values, colormap, reverse)))
+        return f"/overlays/{key}/{{z}}.json"
+
+    def overlay(self, key, z, bbox=None):
+        """GeoJSON bytes of an overlay at zoom ``z``, or None for an unknown overlay"""
+        entry = self.overlays.get(key)
+        if entry is None:
+            return None
+        layer, properties = entry
+        return overlay_json(layer.level(z), properties, bbox)
+
+
+def _tile_handler(server):
+    class TileHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            try:
+                tile = _TILE_PATH.match(url.path)
+                overlay = _OVERLAY_PATH.match(url.path)
+                if tile is not None:
+                    data, content_type = self._tile(tile, query), "image/png"
+                elif overlay is not None:
+                    data, content_type = self._overlay(overlay, query), "application/json"
+                else:
+                    data = None
+            except ValueError:
+                self.send_error(400)
+                return
+            except Exception:
+                # Szczegóły tylko w logu serwera, klient dostaje ogólny błąd
+                logger.exception("Tile server failed on %s", url.path)
+                self.send_error(500)
+                return
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Cache-Control", "max-age=3600")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _tile(self, match, query):
+            colormap = query.get("cmap", ["RdYlGn"])[0]
+            z, x, y = (int(match[k]) for k in ("z", "x", "y"))
+            if colormap not in matplotlib.colormaps or z > 30 or x >= 1 << z or y >= 1 << z:
+                return None
+            reverse = query.get("reverse", ["0"])[0] == "1"
+            return server.tile(match["source"], z, x, y, colormap, reverse)
+
+        def _overlay(self, match, query):
+            bbox = None
+            if "bbox" in query:
+                bbox = [float(v) for v in query["bbox"][0].split(",")]
+                if len(bbox) != 4:
+                    raise ValueError("bbox needs four values")
+            return server.overlay(match["overlay"], int(match["z"]), bbox)
+
+        def log_message(self, format, *args):
+            pass
+
+    return TileHandler
+
+
+_SERVER = None
+_SERVER_LOCK = threading.Lock()
+
+
+def tile_server():
+    """Process-wide tile server, started on first use"""
+    global _SERVER
+    with _SERVER_LOCK:
+        if _SERVER is None:
+            _SERVER = TileServer()
+        return _SERVER
+
+
+def tile_origin():
+    """(public URL, port) the browser uses to reach the tile server; an empty URL means the page host"""
+    server = tile_server()
+    return server.public_url, server.port
+
+
+def tile_url(key, array, profile, colormap, reverse=False):
+    """Leaflet URL path template of the coloured index tiles of one source (see ``tile_origin``)"""
+    template = tile_server().register(key, array, profile)
+    return f"{template}?cmap={colormap}&reverse={int(bool(reverse))}"
+
+
+def overlay_url(layer_key, geometries, key, values, colormap, reverse=False):
+    """URL path template (``{z}``) of the zoom-dependent choropleth of ``values`` over a vector layer"""
+    return tile_server().register_overlay(layer_key, geometries, key, values, colormap, reverse)
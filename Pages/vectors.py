@@ -0,0 +1,120 @@
+import os
+import zipfile
+from collections import namedtuple
+from contextlib import contextmanager
+
+import fiona
+import geopandas as gpd
+import numpy as np
+import shapely
+from fiona.io import MemoryFile, ZipMemoryFile
+from rasterio.crs import CRS
+from rasterio.transform import array_bounds
+from rasterio.warp import transform_bounds
+from shapely.geometry import box
+
+
+# Formaty warstw wektorowych do statystyk strefowych (Shapefile jako archiwum zip)
+VECTOR_TYPES = ["geojson", "json", "gpkg", "fgb", "kml", "zip"]
+# Sterownik KML jest w GDAL, ale fiona domyślnie go nie udostępnia (tylko odczyt)
+fiona.supported_drivers.setdefault("KML", "r")
+
+
+@contextmanager
+def open_vector(uploaded_file):
+    """Open an uploaded vector layer (GeoJSON, GeoPackage, FlatGeobuf, KML or zipped Shapefile) from memory"""
+    data = uploaded_file.getvalue()
+    if zipfile.is_zipfile(uploaded_file):
+        with zipfile.ZipFile(uploaded_file) as archive:
+            shapefiles = [n for n in archive.namelist() if n.lower().endswith(".shp")]
+        if not shapefiles:
+            raise ValueError("The zip archive does not contain a Shapefile (.shp)")
+        with ZipMemoryFile(data) as memfile, memfile.open(shapefiles[0]) as collection:
+            yield collection
+    else:
+        ext = os.path.splitext(getattr(uploaded_file, "name", ""))[1].lstrip(".").lower() or None
+        with MemoryFile(data, ext=ext) as memfile, memfile.open() as collection:
+            yield collection
+
+
+def raster_footprint(profile):
+    """Bounds (left, bottom, right, top) of a raster profile in its own CRS"""
+    return array_bounds(profile["height"], profile["width"], profile["transform"])
+
+
+def read_vector(uploaded_file, profile=None):
+    """Features of an uploaded vector layer, optionally limited to the footprint of a raster ``profile``.
+
+    With a profile only features whose envelope meets the raster bounds are read
+    (bbox filter in the layer's CRS, applied by OGR), the rest are reprojected to
+    the raster CRS in one call and those not intersecting the footprint are dropped
+    with an STRtree query. Layers without a CRS are assumed to be in the raster CRS.
+    """
+    with open_vector(uploaded_file) as collection:
+        layer_crs = CRS.from_wkt(collection.crs_wkt) if collection.crs_wkt else None
+        columns = list(collection.schema["properties"])
+        records = collection
+        if profile is not None:
+            bounds = raster_footprint(profile)
+            if layer_crs is not None and profile.get("crs") is not None:
+                bounds = transform_bounds(profile["crs"], layer_crs, *bounds, densify_pts=21)
+            records = collection.filter(bbox=bounds)
+        gdf = gpd.GeoDataFrame.from_features(records, crs=layer_crs, columns=columns + ["geometry"])
+
+    if profile is None or profile.get("crs") is None:
+        return gdf
+    if gdf.crs is None:
+        gdf = gdf.set_crs(profile["crs"])
+    elif gdf.crs != profile["crs"]:
+        gdf = gdf.to_crs(profile["crs"])
+
+    footprint = box(*raster_footprint(profile))
+    hits = gdf.sindex.query(footprint, predicate="intersects")
+    hits.sort()
+    return gdf.iloc[hits].reset_index(drop=True)
+
+
+# Poziomy generalizacji nakładki strefowej (zoom Web Mercator); mapa bierze najbliższy niższy
+OVERLAY_ZOOMS = (6, 8, 10, 12, 14, 16)
+# Obiekty mniejsze niż tyle pikseli ekranu są na danym poziomie pomijane
+OVERLAY_MIN_PIXELS = 3
+_EARTH_RADIUS = 6378137.0
+_METERS_PER_DEGREE = 2 * np.pi * _EARTH_RADIUS / 360.0
+
+# Jeden poziom nakładki: indeksy obiektów, ich granice (lon/lat) i geometrie jako teksty GeoJSON
+OverlayLevel = namedtuple("OverlayLevel", ["features", "bounds", "geojson"])
+
+
+def _mercator_to_lonlat(decimals):
+    def transform(xy):
+        lon = np.degrees(xy[:, 0] / _EARTH_RADIUS)
+        lat = np.degrees(np.arctan(np.sinh(xy[:, 1] / _EARTH_RADIUS)))
+        return np.round(np.column_stack([lon, lat]), decimals)
+    return transform
+
+
+def mercator_geometries(geometries):
+    """Geometries of a layer in Web Mercator as a shapely array, with their envelope extents (m)"""
+    mercator = np.asarray(geometries.to_crs(3857).values, dtype=object)
+    bounds = shapely.bounds(mercator)
+    with np.errstate(invalid="ignore"):
+        extent = np.fmax(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1])
+    return mercator, extent
+
+
+def overlay_level(mercator, extent, zoom, tile_size=256):
+    """Simplified copy of a layer for one web map zoom level (``OverlayLevel``).
+
+    Features under ``OVERLAY_MIN_PIXELS`` screen pixels are left out, the rest are
+    simplified with a one-pixel tolerance (Douglas-Peucker; features it breaks are
+    redone topology-preserving) and rounded to about half a pixel in degrees, so a
+    level's size follows what can be seen at that zoom, not the feature count.
+    """
+    pixel = 2 * np.pi * _EARTH_RADIUS / (1 << zoom) / tile_size
+    features = np.flatnonzero(extent >= OVERLAY_MIN_PIXELS * pixel)
+    simplified = shapely.simplify(mercator[features], pixel, preserve_topology=False)
+    broken = np.flatnonzero(shapely.is_empty(simplified) | ~shapely.is_valid(simplified))
+    simplified[broken] = shapely.simplify(mercator[features[broken]], pixel, preserve_topology=True)
+    decimals = int(np.clip(np.ceil(-np.log10(pixel / 2 / _METERS_PER_DEGREE)), 0, 9))
+    lonlat = shapely.transform(simplified, _mercator_to_lonlat(decimals))
+    return OverlayLevel(features, shapely.bounds(lonlat), shapely.to_geojson(lonlat))
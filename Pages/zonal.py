@@ -0,0 +1,379 @@
+from collections import namedtuple
+
+import numpy as np
+import shapely
+from rasterio import features
+
+from Pages.compact import dequantize_index
+from Pages.statistics import HIST_RANGE
+
+
+ZONAL_PERCENTILES = (10, 90)
+# Histogram per obiekt: 10 koszyków po 0.2 na [-1, 1]
+ZONAL_HIST_BINS = 10
+
+# Etykieta 0 = piksel poza wszystkimi poligonami
+BACKGROUND_LABEL = 0
+
+
+def label_dtype(n_features):
+    """Smallest integer type that holds labels 0..n_features"""
+    return np.uint16 if n_features < np.iinfo(np.uint16).max else np.int32
+
+
+def _label_shapes(geometries, labels=None):
+    """(GeoJSON-like geometry, label) pairs, one per polygon part; label = 1 + feature index unless ``labels`` are given.
+
+    Converting shapely geometries one by one through ``__geo_interface__`` costs more
+    than the rasterization itself for tens of thousands of parcels, so the ring
+    coordinates of all polygons are extracted in one vectorized call and sliced.
+    """
+    parts, owner = shapely.get_parts(np.asarray(geometries, dtype=object), return_index=True)
+    polygonal = shapely.get_type_id(parts) == shapely.GeometryType.POLYGON
+    owner_labels = owner + 1 if labels is None else np.asarray(labels)[owner]
+
+    # Inne typy (punkty, linie) - rzadkie, zwykła konwersja
+    for part, label in zip(parts[~polygonal], owner_labels[~polygonal]):
+        yield part.__geo_interface__, int(label)
+
+    rings, ring_part = shapely.get_rings(parts[polygonal], return_index=True)
+    if len(rings) == 0:
+        return
+    part_labels = owner_labels[polygonal].tolist()
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+    coord_edges = np.r_[0, np.flatnonzero(np.diff(coord_ring)) + 1, len(coords)].tolist()
+    coords = coords.tolist()
+    ring_coords = [coords[a:b] for a, b in zip(coord_edges[:-1], coord_edges[1:])]
+    ring_edges = np.r_[0, np.flatnonzero(np.diff(ring_part)) + 1, len(rings)].tolist()
+    ring_part = ring_part.tolist()
+    for a, b in zip(ring_edges[:-1], ring_edges[1:]):
+        yield {"type": "Polygon", "coordinates": ring_coords[a:b]}, part_labels[ring_part[a]]
+
+
+def label_raster(geometries, profile, all_touched=False, labels=None):
+    """Label raster aligned with ``profile``: pixel = 1 + index of the feature covering its centre, 0 = none.
+
+    All features are burned in a single GDAL rasterize call; where features overlap,
+    each pixel is assigned to only one of them. ``labels`` replace the default
+    ``1 + index`` labels.
+    """
+    geometries = list(geometries)
+    dtype = label_dtype(int(np.max(labels)) if labels is not None and len(labels) else len(geometries))
+    shapes = list(_label_shapes(geometries, labels))
+    if not shapes:
+        return np.zeros((profile["height"], profile["width"]), dtype=dtype)
+    return features.rasterize(
+        shapes,
+        out_shape=(profile["height"], profile["width"]),
+        transform=profile["transform"],
+        fill=BACKGROUND_LABEL,
+        all_touched=all_touched,
+        dtype=dtype,
+    )
+
+
+def overlap_passes(geometries):
+    """Pass number of every feature such that features of one pass have disjoint interiors.
+
+    Overlapping pairs come from an STRtree self-query (``intersects``) refined with
+    the DE-9IM interior pattern, so features that only touch share a pass; the
+    overlapping ones are coloured greedily in feature order.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    passes = np.zeros(len(geometries), dtype=np.int64)
+    first, second = shapely.STRtree(geometries).query(geometries, predicate="intersects")
+    pair = first < second
+    first, second = first[pair], second[pair]
+    if len(first) == 0:
+        return passes
+    overlap = shapely.relate_pattern(geometries[first], geometries[second], "T********")
+    first, second = first[overlap], second[overlap]
+    if len(first) == 0:
+        return passes
+
+    # Kolorowanie zachłanne: sąsiedzi o mniejszym indeksie mają już przydzielony przebieg
+    order = np.argsort(second, kind="stable")
+    first, second = first[order].tolist(), second[order]
+    edges = np.r_[0, np.flatnonzero(np.diff(second)) + 1, len(second)].tolist()
+    second = second.tolist()
+    for a, b in zip(edges[:-1], edges[1:]):
+        used = set(passes[first[a:b]].tolist())
+        k = 0
+        while k in used:
+            k += 1
+        passes[second[a]] = k
+    return passes
+
+
+# Pola pokryte poligonami pogrupowane według etykiety; wspólne dla wszystkich indeksów na tej siatce
+Zones = namedtuple("Zones", ["pixels", "labels", "n_features"])
+
+
+def build_zones(geometries, profile, all_touched=False):
+    """Rasterize the features once and group the covered pixels by feature.
+
+    ``pixels`` are flat raster positions sorted by label (``labels``), so any index
+    on the same grid is reduced per feature by gathering these pixels only; the
+    rasterization and the (radix) sort are paid once per vector layer and grid.
+    Overlapping features are burned in extra passes (``overlap_passes``), so a pixel
+    counts towards every feature covering it.
+    """
+    geometries = np.asarray(list(geometries), dtype=object)
+    passes = overlap_passes(geometries)
+    pixels, labels = [], []
+    for p in range(int(passes.max()) + 1 if len(passes) else 1):
+        members = np.flatnonzero(passes == p)
+        flat = label_raster(geometries[members], profile, all_touched, labels=members + 1).ravel()
+        covered = np.flatnonzero(flat)
+        pixels.append(covered)
+        labels.append(flat[covered].astype(label_dtype(len(geometries)), copy=False))
+    pixels, labels = np.concatenate(pixels), np.concatenate(labels)
+    if profile["height"] * profile["width"] <= np.iinfo(np.int32).max:
+        pixels = pixels.astype(np.int32)
+    order = np.argsort(labels, kind="stable")
+    return Zones(pixels[order], labels[order], len(geometries))
+
+
+def zonal_table(zones, values, percentiles=ZONAL_PERCENTILES, bins=ZONAL_HIST_BINS, value_range=HIST_RANGE):
+    """Per-feature statistics of one index from grouped reductions over the zone pixels.
+
+    Moments come from ``np.bincount``; order statistics (min, max, median,
+    percentiles) from one sort of ``label * 4 + value`` keys, which orders values
+    inside each feature's contiguous run (NaN keys go to the end of their run).
+    ``majority`` is the centre of the most populated histogram bin and ``histogram``
+    the per-feature pixel counts in ``bins`` fixed bins over ``value_range``.
+    Features without valid pixels get NaN.
+    """
+    size = zones.n_features + 1
+    labels = zones.labels
+    v = dequantize_index(np.ravel(values)[zones.pixels]).astype(np.float64, copy=False)
+    nan = np.isnan(v)
+
+    count = np.bincount(labels[~nan], minlength=size)[1:]
+    run = np.bincount(labels, minlength=size)[1:]
+    start = np.cumsum(run) - run
+    v_zero = np.where(nan, 0.0, v)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(labels, weights=v_zero, minlength=size)[1:] / count
+        variance = np.bincount(labels, weights=v_zero * v_zero, minlength=size)[1:] / count - mean * mean
+
+    # Klucz sortowania: etykieta * 4 + (wartość + 1) z [0, 2]; NaN -> 3 (koniec grupy)
+    lo, hi = value_range
+    key = np.where(nan, 3.0, (v - lo) * (2.0 / (hi - lo)))
+    key += labels * 4.0
+    key.sort()
+    key -= labels * 4.0
+    # Wartownik NaN na końcu: indeksy pustych obiektów na końcu tablicy pozostają poprawne
+    ordered = np.append(key, np.nan)
+    ordered *= (hi - lo) / 2.0
+    ordered += lo
+
+    empty = count == 0
+    last = start + np.maximum(count - 1, 0)
+
+    def percentile(q):
+        rank = q / 100.0 * np.maximum(count - 1, 0)
+        below = np.floor(rank).astype(np.int64)
+        frac = rank - below
+        at = np.minimum(start + below, last)
+        value = ordered[at] + frac * (ordered[np.minimum(at + 1, last)] - ordered[at])
+        return np.where(empty, np.nan, value)
+
+    width = (hi - lo) / bins
+    bin_index = np.clip(((v[~nan] - lo) / width).astype(np.int64), 0, bins - 1)
+    histogram = np.bincount(labels[~nan].astype(np.int64) * bins + bin_index, minlength=size * bins)
+    histogram = histogram.reshape(size, bins)[1:]
+
+    stats = {
+        "mean": mean,
+        "min": np.where(empty, np.nan, ordered[start]),
+        "max": np.where(empty, np.nan, ordered[last]),
+        "std": np.sqrt(np.clip(variance, 0.0, None)),
+        "count": count,
+        "median": percentile(50),
+    }
+    stats.update({f"p{q}": percentile(q) for q in percentiles})
+    stats["majority"] = np.where(empty, np.nan, lo + (histogram.argmax(axis=1) + 0.5) * width)
+    stats["histogram"] = histogram
+    return stats
+
+
+def histogram_columns(histogram, value_range=HIST_RANGE):
+    """Per-bin count columns (``hist[lo,hi)``) of a per-feature histogram array"""
+    lo, hi = value_range
+    edges = np.linspace(lo, hi, histogram.shape[1] + 1)
+    return {f"hist[{a:+.1f},{b:+.1f})": histogram[:, i] for i, (a, b) in enumerate(zip(edges[:-1], edges[1:]))}
+
+
+# Wagi pokrycia jako macierz rzadka COO (obiekt x piksel), posortowana po obiekcie;
+# kolumny to płaskie pozycje pikseli rastra
+Coverage = namedtuple("Coverage", ["rows", "pixels", "weights", "n_features"])
+
+# Limit komórek płócien obiektów przetwarzanych naraz (float64)
+COVERAGE_BLOCK_CELLS = 8 * 1024 * 1024
+COVERAGE_EPS = 1e-9
+
+
+def _pixel_segments(geometries, profile):
+    """Polygon ring edges in pixel coordinates (x = column, y = row), with their feature and sign.
+
+    Features are clipped to the raster first. The sign makes every exterior ring
+    add and every hole subtract coverage, whatever the ring orientation.
+    """
+    height, width = profile["height"], profile["width"]
+    # Współczynniki afiniczne wprost (mnożenie Affine * krotka jest przestarzałe)
+    a, b, c, d, e, f = profile["transform"][:6]
+    ia, ib, ic, id_, ie, if_ = (~profile["transform"])[:6]
+    left, top = c, f
+    right, bottom = a * width + b * height + c, d * width + e * height + f
+    clipped = shapely.clip_by_rect(
+        np.asarray(geometries, dtype=object), min(left, right), min(top, bottom), max(left, right), max(top, bottom),
+    )
+    pixel_geoms = shapely.transform(
+        clipped, lambda xy: np.column_stack((ia * xy[:, 0] + ib * xy[:, 1] + ic, id_ * xy[:, 0] + ie * xy[:, 1] + if_)),
+    )
+
+    parts, part_feature = shapely.get_parts(pixel_geoms, return_index=True)
+    polygons = shapely.get_type_id(parts) == shapely.GeometryType.POLYGON
+    parts, part_feature = parts[polygons], part_feature[polygons]
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    exterior = np.r_[True, np.diff(ring_part) != 0] if len(rings) else np.zeros(0, dtype=bool)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+
+    same_ring = coord_ring[:-1] == coord_ring[1:]
+    start, end = coords[:-1][same_ring], coords[1:][same_ring]
+    seg_ring = coord_ring[:-1][same_ring]
+
+    # Znak pierścienia z całki x dy (wzór Gaussa); dziury odejmują pokrycie
+    x_dy = np.bincount(seg_ring, weights=(start[:, 0] + end[:, 0]) * (end[:, 1] - start[:, 1]),
+                       minlength=len(rings))
+    ring_sign = -np.sign(x_dy) * np.where(exterior, 1.0, -1.0)
+    return start, end, part_feature[ring_part[seg_ring]], ring_sign[seg_ring], pixel_geoms
+
+
+def _split_at_grid(start, end):
+    """Split segments at every integer column/row line; returns piece endpoints and the source segment"""
+    def crossings(a, b):
+        lo = np.floor(np.minimum(a, b)) + 1
+        hi = np.ceil(np.maximum(a, b)) - 1
+        return lo.astype(np.int64), np.maximum(hi - lo + 1, 0).astype(np.int64)
+
+    n = len(start)
+    delta = end - start
+    ts = [np.zeros(n), np.ones(n)]
+    segs = [np.arange(n), np.arange(n)]
+    for axis in (0, 1):
+        lo, count = crossings(start[:, axis], end[:, axis])
+        seg = np.repeat(np.arange(n), count)
+        step = np.arange(len(seg)) - np.repeat(np.cumsum(count) - count, count)
+        ts.append((lo[seg] + step - start[seg, axis]) / delta[seg, axis])
+        segs.append(seg)
+    # Jeden klucz zamiast lexsort: 2 * odcinek + t, t z [0, 1]
+    key = np.concatenate(segs) * 2.0
+    key += np.concatenate(ts)
+    key.sort()
+    seg = (key // 2).astype(np.int64)
+    t = key - 2.0 * seg
+    same = seg[:-1] == seg[1:]
+    seg, t0, t1 = seg[:-1][same], t[:-1][same], t[1:][same]
+    p0 = start[seg] + t0[:, None] * delta[seg]
+    p1 = start[seg] + t1[:, None] * delta[seg]
+    return p0, p1, seg
+
+
+def coverage_weights(geometries, profile, block_cells=COVERAGE_BLOCK_CELLS):
+    """Exact fraction of every raster pixel covered by every feature, as a sparse COO matrix.
+
+    Ring edges are split at pixel boundaries; each piece deposits its signed height
+    into the cell it crosses and the next one (the area to its right), and a prefix
+    sum along each row of the feature's bounding-box canvas turns the deposits into
+    exact coverage - the scanline accumulation used by anti-aliasing rasterizers.
+    Features are processed in groups of canvases of at most ``block_cells`` cells.
+    """
+    geometries = list(geometries)
+    n_features = len(geometries)
+    start, end, seg_feature, seg_sign, pixel_geoms = _pixel_segments(geometries, profile)
+    p0, p1, seg = _split_at_grid(start, end)
+    dy = (p1[:, 1] - p0[:, 1]) * seg_sign[seg]
+    moving = dy != 0
+    mid = (p0[moving] + p1[moving]) / 2.0
+    dy, piece_feature = dy[moving], seg_feature[seg[moving]]
+    col = np.floor(mid[:, 0]).astype(np.int64)
+    row = np.floor(mid[:, 1]).astype(np.int64)
+    frac = mid[:, 0] - col
+
+    # Płótno obiektu: jego bbox w pikselach + jedna kolumna na depozyt z prawej
+    bounds = shapely.bounds(pixel_geoms)
+    has_area = np.zeros(n_features, dtype=bool)
+    has_area[piece_feature] = True
+    bounds[~has_area] = 0.0
+    c0 = np.floor(bounds[:, 0]).astype(np.int64)
+    r0 = np.floor(bounds[:, 1]).astype(np.int64)
+    widths = np.where(has_area, np.floor(bounds[:, 2]).astype(np.int64) - c0 + 2, 0)
+    heights = np.where(has_area, np.floor(bounds[:, 3]).astype(np.int64) - r0 + 1, 0)
+    cells = widths * heights
+
+    rows, pixels, weights = [], [], []
+    piece_edges = np.searchsorted(piece_feature, np.arange(n_features + 1))
+    first = 0
+    while first < n_features:
+        last = first + 1
+        total = cells[first]
+        while last < n_features and total + cells[last] <= block_cells:
+            total += cells[last]
+            last += 1
+        a, b = piece_edges[first], piece_edges[last]
+        offsets = np.cumsum(cells[first:last]) - cells[first:last]
+        f = piece_feature[a:b] - first
+        index = offsets[f] + (row[a:b] - r0[first:last][f]) * widths[first:last][f] + (col[a:b] - c0[first:last][f])
+        canvas = np.bincount(index, weights=dy[a:b] * (1.0 - frac[a:b]), minlength=total)
+        canvas += np.bincount(index + 1, weights=dy[a:b] * frac[a:b], minlength=total + 1)[:total]
+
+        # Suma prefiksowa w obrębie każdego wiersza płótna
+        np.cumsum(canvas, out=canvas)
+        row_widths = np.repeat(widths[first:last], heights[first:last])
+        row_ends = np.cumsum(row_widths)
+        before = np.r_[0.0, canvas[row_ends[:-1] - 1]] if len(row_ends) else np.zeros(0)
+        canvas -= np.repeat(before, row_widths)
+
+        cell = np.flatnonzero(canvas > COVERAGE_EPS)
+        feature = np.searchsorted(offsets, cell, side="right") - 1
+        local = cell - offsets[feature]
+        feature += first
+        pixel_row = r0[feature] + local // widths[feature]
+        pixel_col = c0[feature] + local % widths[feature]
+        inside = (pixel_col < profile["width"]) & (pixel_row < profile["height"])
+        rows.append(feature[inside])
+        pixels.append(pixel_row[inside] * profile["width"] + pixel_col[inside])
+        weights.append(np.minimum(canvas[cell[inside]], 1.0))
+        first = last
+
+    return Coverage(
+        np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64),
+        np.concatenate(pixels) if pixels else np.zeros(0, dtype=np.int64),
+        np.concatenate(weights) if weights else np.zeros(0),
+        n_features,
+    )
+
+
+def coverage_matvec(coverage, x):
+    """Sparse product ``W @ x`` of the coverage matrix with ``x`` gathered at its non-zeros"""
+    return np.bincount(coverage.rows, weights=coverage.weights * x, minlength=coverage.n_features)
+
+
+def weighted_zonal_table(coverage, values):
+    """Area-weighted per-feature mean, std and sum of one index, plus the covered valid area (in pixels).
+
+    Every statistic is one sparse mat-vec with the cached coverage weights; NaN
+    pixels get weight zero.
+    """
+    v = dequantize_index(np.ravel(values)[coverage.pixels]).astype(np.float64, copy=False)
+    # Wartości są zebrane dla każdego niezerowego elementu macierzy
+    valid = ~np.isnan(v)
+    v = np.where(valid, v, 0.0)
+    area = coverage_matvec(coverage, valid.astype(np.float64))
+    total = coverage_matvec(coverage, v)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / area
+        variance = coverage_matvec(coverage, v * v) / area - mean * mean
+    return {"mean": mean, "std": np.sqrt(np.clip(variance, 0.0, None)), "sum": total, "coverage": area}
@@ -0,0 +1,108 @@
+import io
+import json
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from Pages import maps
+
+
+def _band(name, seed):
+    data = np.random.default_rng(seed).integers(1, 10000, (200, 200)).astype("uint16")
+    with rasterio.MemoryFile() as mf:
+        with mf.open(driver="GTiff", dtype="uint16", count=1, width=200, height=200, crs="EPSG:32633",
+                     transform=from_origin(500000, 5800000, 10, 10)) as dst:
+            dst.write(data, 1)
+        upload = io.BytesIO(mf.read())
+    upload.name = name
+    return upload
+
+
+# Prostokąt wewnątrz rastra (EPSG:32633, 500000-502000 E, 5798000-5800000 N) w lon/lat
+INSIDE = [[15.005, 52.345], [15.02, 52.345], [15.02, 52.335], [15.005, 52.335], [15.005, 52.345]]
+
+
+def _vector(polygon=INSIDE):
+    upload = io.BytesIO(json.dumps({"type": "FeatureCollection", "features": [
+        {"type": "Feature", "properties": {"id": 1}, "geometry": {"type": "Polygon", "coordinates": [polygon]}},
+    ]}).encode("utf-8"))
+    upload.name = "fields.geojson"
+    return upload
+
+
+@pytest.fixture
+def rendered_maps(monkeypatch):
+    shown = []
+    monkeypatch.setattr(maps, "st_folium", lambda m, **kwargs: shown.append(m))
+    return shown
+
+
+def _process(uploaded_bands, uploaded_vector, zonal_mode=maps.ZONAL_CENTRE):
+    maps.process_raster_data(
+        uploaded_bands=uploaded_bands, uploaded_vector=uploaded_vector, zonal_mode=zonal_mode,
+        index_type="NDVI", batch_indices=["NDVI"],
+        engine_options=dict(engine=maps.ENGINE_IN_MEMORY, precision=maps.PRECISION_FAST, workers=1,
+                            grid_mode="finest", grid_resolution=10.0, resampling="bilinear"),
+        mask_options=dict(scl_classes=(), cirrus_threshold=None, qa_bits=0),
+        export_options=dict(codec="DEFLATE", level=6),
+        colormap="RdYlGn", reverse_cmap=False, map_title="NDVI", show_scale=True, show_north=True,
+        show_legend=True, scale_mode="Auto from GeoTIFF (projected CRS)", manual_m_per_px=10.0,
+        scale_bar_percentage=90,
+    )
+
+
+def _overlays(m):
+    return [child for child in m._children.values() if isinstance(child, maps.ZoomOverlay)]
+
+
+def test_vector_uploaded_after_first_run_shows_zonal_layer(rendered_maps):
+    bands = [_band("T33UVU_B04.tif", 1), _band("T33UVU_B08.tif", 2)]
+    _process(bands, None)
+    _process(bands, _vector())
+
+    first, second = rendered_maps
+    assert _overlays(first) == []
+    overlay, = _overlays(second)
+    html = second.get_root().render()
+    assert "L.geoJSON" in html
+    assert overlay.url in html
+
+
+def test_zonal_mode_change_updates_zonal_layer(rendered_maps):
+    bands = [_band("T33UVU_B04.tif", 3), _band("T33UVU_B08.tif", 4)]
+    vector = _vector()
+    _process(bands, vector, maps.ZONAL_CENTRE)
+    _process(bands, vector, maps.ZONAL_WEIGHTED)
+
+    centre, weighted = (_overlays(m)[0].url for m in rendered_maps)
+    assert centre != weighted
+
+
+def _bad_vectors():
+    malformed = io.BytesIO(b'{"type": "FeatureCollection", "features": [')
+    malformed.name = "broken.geojson"
+    elsewhere = _vector([[20.0, 50.1], [20.1, 50.1], [20.1, 50.0], [20.0, 50.0], [20.0, 50.1]])
+    return [malformed, elsewhere]
+
+
+@pytest.mark.parametrize("case", [0, 1], ids=["malformed", "outside-raster"])
+def test_bad_vector_keeps_index_map(rendered_maps, case):
+    bands = [_band("T33UVU_B04.tif", 5), _band("T33UVU_B08.tif", 6)]
+    _process(bands, _bad_vectors()[case])
+
+    m, = rendered_maps
+    assert _overlays(m) == []
+    assert any(isinstance(child, maps.LocalTileLayer) for child in m._children.values())
+
+
+def test_overlay_error_keeps_index_map(rendered_maps, monkeypatch):
+    def broken(run, index):
+        raise RuntimeError("overlay failed")
+    monkeypatch.setattr(maps, "zonal_overlay", broken)
+    _process([_band("T33UVU_B04.tif", 7), _band("T33UVU_B08.tif", 8)], _vector())
+
+    m, = rendered_maps
+    assert _overlays(m) == []
+    assert any(isinstance(child, maps.LocalTileLayer) for child in m._children.values())
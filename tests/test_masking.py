@@ -0,0 +1,22 @@
+import numpy as np
+
+from Pages.masking import DEFAULT_RADIOMETRIC_OFFSET, layer_valid, mask_rules
+
+
+# Odbicie B10: czyste niebo 0.005, cirrus 0.030 (próg domyślny 0.012)
+CLEAR, CIRRUS = 0.005, 0.030
+
+
+def _b10(offset):
+    return np.array([CLEAR, CIRRUS]) * 10000 + offset
+
+
+def test_cirrus_mask_baseline_04_offset():
+    rule = mask_rules(cirrus_threshold=0.012)["B10"]
+    assert DEFAULT_RADIOMETRIC_OFFSET == 1000
+    assert layer_valid(rule, _b10(1000)).tolist() == [True, False]
+
+
+def test_cirrus_mask_pre_04_baseline():
+    rule = mask_rules(cirrus_threshold=0.012, radiometric_offset=0)["B10"]
+    assert layer_valid(rule, _b10(0)).tolist() == [True, False]
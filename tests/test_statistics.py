@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from Pages.compact import quantize_index
+from Pages.statistics import HIST_BINS, HIST_RANGE, array_stats, progressive_array_stats, summarize_stats
+
+
+BIN_WIDTH = (HIST_RANGE[1] - HIST_RANGE[0]) / HIST_BINS
+
+
+def _index(seed=0, shape=(300, 400)):
+    rng = np.random.default_rng(seed)
+    array = np.clip(rng.normal(0.3, 0.25, shape), -1, 1).astype(np.float32)
+    array[rng.random(shape) < 0.1] = np.nan
+    return array
+
+
+def test_blocked_moments_match_numpy():
+    array = _index()
+    # Bloki po 1000 pikseli: 300 wierszy w wielu częściach scalanych wzorem Chana
+    stats = summarize_stats(array_stats(array, block_pixels=1000))
+    valid = array[~np.isnan(array)].astype(np.float64)
+    assert stats["count"] == valid.size
+    assert stats["mean"] == pytest.approx(valid.mean(), rel=1e-9)
+    assert stats["std"] == pytest.approx(valid.std(), rel=1e-9)
+    assert (stats["min"], stats["max"]) == (valid.min(), valid.max())
+    assert stats["masked_pct"] == pytest.approx(100.0 * (1 - valid.size / array.size))
+
+
+def test_block_size_does_not_change_result():
+    array = _index(1)
+    small = summarize_stats(array_stats(array, block_pixels=512))
+    whole = summarize_stats(array_stats(array, block_pixels=array.size))
+    np.testing.assert_array_equal(small.pop("histogram"), whole.pop("histogram"))
+    assert small == pytest.approx(whole, rel=1e-8)
+
+
+@pytest.mark.parametrize("q", [10, 25, 50, 75, 90])
+def test_histogram_quantiles_within_one_bin(q):
+    array = _index(2)
+    stats = summarize_stats(array_stats(array))
+    key = "median" if q == 50 else f"p{q}"
+    assert abs(stats[key] - np.nanpercentile(array, q)) <= BIN_WIDTH
+
+
+def test_compact_index_matches_float():
+    array = _index(3)
+    compact = summarize_stats(array_stats(quantize_index(array)))
+    exact = summarize_stats(array_stats(array))
+    assert compact["count"] == exact["count"]
+    # Kwantyzacja 1e-4: średnia i percentyle różnią się o najwyżej pół kroku
+    assert compact["mean"] == pytest.approx(exact["mean"], abs=5e-5)
+    assert compact["median"] == pytest.approx(exact["median"], abs=BIN_WIDTH)
+
+
+def test_all_nan_gives_nan_statistics():
+    stats = summarize_stats(array_stats(np.full((4, 5), np.nan, dtype=np.float32)))
+    assert stats["count"] == 0 and stats["masked_pct"] == 100.0
+    assert np.isnan(stats["mean"]) and np.isnan(stats["median"])
+
+
+def test_progressive_estimates_have_finite_intervals():
+    array = _index(4, shape=(64, 64))
+    estimates = []
+    # Bloki po jednym wierszu, raport po każdym bloku
+    total = progressive_array_stats(array, estimates.append, block_pixels=64, interval=0.0)
+
+    assert len(estimates) == 1 + 64 - 2
+    assert all(np.isfinite(e["mean_ci"]) and np.isfinite(e["median_ci"]).all() for e in estimates)
+    assert summarize_stats(total)["mean"] == pytest.approx(summarize_stats(array_stats(array))["mean"])
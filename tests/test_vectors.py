@@ -0,0 +1,65 @@
+import io
+import json
+import zipfile
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+
+from Pages.vectors import read_vector
+
+
+FIELD = box(15.005, 52.335, 15.02, 52.345)
+
+
+def _upload(data, name):
+    upload = io.BytesIO(data)
+    upload.name = name
+    return upload
+
+
+def _geojson():
+    return json.dumps({"type": "FeatureCollection", "features": [
+        {"type": "Feature", "properties": {"id": 1}, "geometry": FIELD.__geo_interface__},
+    ]}).encode("utf-8")
+
+
+def _kml():
+    coords = " ".join(f"{x},{y}" for x, y in FIELD.exterior.coords)
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><kml xmlns="http://www.opengis.net/kml/2.2"><Document>'
+        f"<Placemark><name>1</name><Polygon><outerBoundaryIs><LinearRing><coordinates>{coords}"
+        "</coordinates></LinearRing></outerBoundaryIs></Polygon></Placemark></Document></kml>"
+    ).encode("utf-8")
+
+
+def _written(driver, suffix, tmp_path):
+    gdf = gpd.GeoDataFrame({"id": [1]}, geometry=[FIELD], crs="EPSG:4326")
+    path = tmp_path / f"fields.{suffix}"
+    gdf.to_file(path, driver=driver)
+    return path.read_bytes()
+
+
+def _shapefile_zip(tmp_path):
+    gpd.GeoDataFrame({"id": [1]}, geometry=[FIELD], crs="EPSG:4326").to_file(tmp_path / "fields.shp")
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as archive:
+        for part in tmp_path.glob("fields.*"):
+            archive.write(part, part.name)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize("name", ["fields.geojson", "fields.gpkg", "fields.fgb", "fields.kml", "fields.zip"])
+def test_read_vector_formats(name, tmp_path):
+    data = {
+        "fields.geojson": _geojson,
+        "fields.gpkg": lambda: _written("GPKG", "gpkg", tmp_path),
+        "fields.fgb": lambda: _written("FlatGeobuf", "fgb", tmp_path),
+        "fields.kml": _kml,
+        "fields.zip": lambda: _shapefile_zip(tmp_path),
+    }[name]()
+
+    gdf = read_vector(_upload(data, name))
+    assert len(gdf) == 1
+    assert gdf.crs.to_epsg() == 4326
+    assert gdf.geometry.iloc[0].equals(FIELD)
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+import shapely
+from rasterio.transform import from_origin
+from shapely.geometry import Polygon, box
+
+from Pages.zonal import build_zones, coverage_weights, histogram_columns, weighted_zonal_table, zonal_table
+
+
+# Siatka 20 x 30 pikseli po 10 m, lewy górny narożnik (1000, 2000)
+PROFILE = dict(height=20, width=30, transform=from_origin(1000, 2000, 10, 10))
+PIXEL_AREA = 100.0
+
+
+def _weights(coverage, feature):
+    """{(row, col): weight} of one feature"""
+    rows = coverage.rows == feature
+    return {
+        divmod(int(p), PROFILE["width"]): w
+        for p, w in zip(coverage.pixels[rows].tolist(), coverage.weights[rows].tolist())
+        if w > 1e-12
+    }
+
+
+@pytest.mark.parametrize("geometry", [
+    Polygon([(1003, 1997), (1200, 1950), (1100, 1830)]),
+    box(1012, 1900, 1260, 1987.5).difference(box(1050, 1920, 1100, 1960)),
+    shapely.MultiPolygon([box(1001, 1991, 1004, 1999), box(1201, 1811, 1288, 1844)]),
+])
+def test_weights_sum_to_area(geometry):
+    coverage = coverage_weights([geometry], PROFILE)
+    assert coverage.weights.sum() == pytest.approx(geometry.area / PIXEL_AREA)
+    assert coverage.weights.max() <= 1.0 + 1e-9
+
+
+def test_partial_pixels_match_hand_computed_fractions():
+    # x 1005-1015: po połowie kolumn 0 i 1; y 1993-1985: 0.3 wiersza 0 i 0.5 wiersza 1
+    rectangle = box(1005, 1985, 1015, 1993)
+    # Trójkąt nad przekątną piksela (2, 3): połowa piksela
+    triangle = Polygon([(1030, 1980), (1040, 1980), (1030, 1970)])
+    coverage = coverage_weights([rectangle, triangle], PROFILE)
+
+    expected = {(0, 0): 0.15, (0, 1): 0.15, (1, 0): 0.25, (1, 1): 0.25}
+    got = _weights(coverage, 0)
+    assert got.keys() == expected.keys()
+    assert [got[k] for k in expected] == pytest.approx(list(expected.values()))
+    assert _weights(coverage, 1) == pytest.approx({(2, 3): 0.5})
+
+
+def test_feature_outside_raster_is_clipped():
+    # Połowa kwadratu wystaje poza lewą krawędź rastra
+    coverage = coverage_weights([box(990, 1980, 1010, 2000)], PROFILE)
+    assert _weights(coverage, 0) == pytest.approx({(0, 0): 1.0, (1, 0): 1.0})
+
+
+def test_weighted_mean_of_partial_pixels():
+    values = np.tile(np.arange(PROFILE["width"], dtype=np.float32), (PROFILE["height"], 1))
+    values[1, 1] = np.nan
+    # 1/4 piksela w kolumnie 0, 3/4 w kolumnie 1 (wiersz 0); NaN w (1, 1) nie liczy się do średniej
+    stats = weighted_zonal_table(coverage_weights([box(1007.5, 1990, 1017.5, 2000)], PROFILE), values)
+    assert stats["coverage"][0] == pytest.approx(1.0)
+    assert stats["mean"][0] == pytest.approx(0.25 * 0 + 0.75 * 1)
+
+
+def test_overlapping_features_share_pixels():
+    first, second = box(1000, 1950, 1050, 2000), box(1030, 1930, 1080, 1980)
+    zones = build_zones([first, second], PROFILE)
+    counts = np.bincount(zones.labels, minlength=3)[1:]
+    assert counts.tolist() == [25, 25]
+    # Wspólne 2 x 3 piksele: x 1030-1050, y 1950-1980
+    shared = set(zones.pixels[zones.labels == 1].tolist()) & set(zones.pixels[zones.labels == 2].tolist())
+    assert len(shared) == 6
+
+
+def _zone_values():
+    rng = np.random.default_rng(0)
+    values = rng.uniform(-0.2, 0.8, (PROFILE["height"], PROFILE["width"])).astype(np.float32)
+    values[rng.random(values.shape) < 0.1] = np.nan
+    return values
+
+
+def test_zonal_order_statistics_match_numpy():
+    fields = [box(1000, 1900, 1150, 2000), box(1120, 1800, 1300, 1950), box(1290, 1990, 1300, 2000)]
+    values = _zone_values()
+    zones = build_zones(fields, PROFILE)
+    stats = zonal_table(zones, values)
+
+    for i in range(len(fields)):
+        v = values.ravel()[zones.pixels[zones.labels == i + 1]].astype(np.float64)
+        v = v[~np.isnan(v)]
+        assert stats["count"][i] == v.size
+        assert stats["mean"][i] == pytest.approx(v.mean())
+        assert stats["std"][i] == pytest.approx(v.std())
+        # Wartości są odtwarzane z klucza sortowania (float64), więc zgodność do błędu zaokrąglenia
+        assert stats["min"][i] == pytest.approx(v.min(), abs=1e-12)
+        assert stats["max"][i] == pytest.approx(v.max(), abs=1e-12)
+        for q in (10, 50, 90):
+            assert stats["median" if q == 50 else f"p{q}"][i] == pytest.approx(np.percentile(v, q), abs=1e-12)
+
+
+def test_majority_is_centre_of_modal_bin():
+    values = np.full((PROFILE["height"], PROFILE["width"]), 0.9, dtype=np.float32)
+    # Obiekt 2 x 2 piksele: trzy wartości w koszyku [0.2, 0.3), jedna w [0.5, 0.6)
+    values[0, :2], values[1, :2] = (0.21, 0.29), (0.25, 0.55)
+    stats = zonal_table(build_zones([box(1000, 1980, 1020, 2000)], PROFILE), values, bins=20)
+
+    assert stats["majority"][0] == pytest.approx(0.25)
+    histogram = stats["histogram"][0]
+    assert histogram.sum() == 4
+    assert histogram[12] == 3 and histogram[15] == 1
+    assert histogram_columns(stats["histogram"])["hist[+0.2,+0.3)"].tolist() == [3]
+
+
+def test_feature_without_valid_pixels_is_nan():
+    values = np.full((PROFILE["height"], PROFILE["width"]), np.nan, dtype=np.float32)
+    stats = zonal_table(build_zones([box(1000, 1980, 1020, 2000)], PROFILE), values)
+    assert stats["count"][0] == 0
+    assert all(np.isnan(stats[k][0]) for k in ("mean", "min", "max", "median", "majority"))